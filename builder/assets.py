@@ -1,36 +1,124 @@
+from __future__ import annotations
+
+import concurrent.futures
 import dataclasses
 import logging
 import mimetypes
+import os
 import shutil
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
 
-import PIL.Image
+from config import CONFIG, Config, configure
+from imageinfo import IMAGE_INDEX
+from manifest import Manifest, digest, file_digest
+from placeholders import PLACEHOLDER_WIDTH, PLACEHOLDERS, make_placeholder
+from sourceindex import SOURCE_INDEX
+from tracing import TRACER, init_worker
+from util import link_or_copy, report_planned
 
-from config import CONFIG
+if TYPE_CHECKING:
+    import PIL.Image
 
 mimetypes.add_type('image/webp', '.webp')
 
 
-def is_up_to_date(source: Path, target: Path) -> bool:
-    return target.exists() and target.stat().st_mtime >= source.stat().st_mtime
+def flatten_alpha(img: PIL.Image.Image) -> PIL.Image.Image:
+    """ paste an image with transparency onto CONFIG.background_color, for formats without alpha channel.
 
+    RGBA and LA images are pasted directly, using their own alpha as mask, so the only full-size
+    intermediate is the RGB result.
+    """
+    if img.mode in ('RGB', 'L', 'CMYK'):
+        return img
+    import PIL.Image
+    if img.mode not in ('RGBA', 'LA'):
+        img = img.convert('RGBA')
+    background = PIL.Image.new('RGB', img.size, CONFIG.background_color)
+    background.paste(img, mask=img)
+    return background
 
-def convert_image(source: Path, target: Path, source_mimetype: str, target_mimetype: str):
-    with PIL.Image.open(source) as img:
-        if img.mode == 'RGBA' and target_mimetype == 'image/jpeg':
-            background = PIL.Image.new('RGBA', img.size, CONFIG.background_color)
-            background.paste(img, mask=img)
-            img = background.convert('RGB')
-        img.save(target)
+
+def resize_to_width(img: PIL.Image.Image, width: int | None) -> PIL.Image.Image:
+    """ scale an image down to the given width, preserving aspect ratio. Images are never scaled up. """
+    if width is None or width >= img.width:
+        return img
+    import PIL.Image
+    if img.mode in ('1', 'P'):
+        img = img.convert('RGBA')  # palette images can only be resized with nearest-neighbour resampling
+    return img.resize((width, max(1, round(img.height * width / img.width))), PIL.Image.Resampling.LANCZOS)
+
+
+def save_image(img: PIL.Image.Image, target: Path, target_mimetype: str):
+    if target_mimetype == 'image/jpeg':
+        img = flatten_alpha(img)
+    img.save(target, quality=CONFIG.image_quality)
+
+
+def open_image(source: Path, width: int = None) -> PIL.Image.Image:
+    """ open and decode an image, at a reduced resolution if it will only be scaled down to at most `width`.
+
+    JPEGs are decoded at a reduced scale (draft mode). Other formats are decoded at full size, and then reduced
+    by an integer factor at once, so that the full-size image can be released before any further scaling.
+    The result is never narrower than `width`.
+    """
+    import PIL.Image
+    img = PIL.Image.open(source)
+    if width is None or width >= img.width:
+        img.load()
+        return img
+    if img.format == 'JPEG':
+        img.draft(img.mode, (width, max(1, round(img.height * width / img.width))))
+    img.load()
+    if (factor := img.width // width) > 1:
+        if img.mode in ('1', 'P'):
+            img = img.convert('RGBA')  # palette images cannot be reduced
+        reduced = img.reduce(factor)
+        img.close()
+        img = reduced
+    return img
 
 
-def convert_video(source: Path, target: Path, source_mimetype: str, target_mimetype: str):
-    raise NotImplementedError()
+def convert_image(source: Path, target: Path, source_mimetype: str, target_mimetype: str, width: int = None):
+    with open_image(source, width) as img:
+        save_image(resize_to_width(img, width), target, target_mimetype)
+
+
+def frame_durations(img: PIL.Image.Image) -> list[int]:
+    """ display time in milliseconds of each frame of an animated image.
+
+    Seeking to a frame decodes the frames before it (GIF frames are drawn over the previous ones), so this is a
+    full pass over the animation.
+    """
+    durations = []
+    for frame in range(img.n_frames):
+        img.seek(frame)
+        durations.append(img.info.get('duration', 0))
+    img.seek(0)
+    return durations
+
+
+def convert_animation(source: Path, target: Path, source_mimetype: str, target_mimetype: str):
+    """ convert an animated image (e.g. GIF) to an animated WebP at its original size.
+
+    The animation is decoded twice: once for the frame durations, which the encoder needs up front, and once while
+    encoding. Both passes go frame by frame, so only the current (and previous, for disposal) frame is held in memory,
+    never the whole animation.
+    """
+    if target_mimetype != 'image/webp':
+        raise NotImplementedError(f'cannot convert animation {source} to {target_mimetype}')
+    import PIL.Image
+    with PIL.Image.open(source) as img:
+        durations = frame_durations(img)
+        img.save(target, format='WEBP', save_all=True, duration=durations, loop=img.info.get('loop', 1), quality=CONFIG.image_quality)
 
 
-def copy_or_convert(source: Path, target: Path, source_mimetype: str, target_mimetype: str):
-    """ Copy source to target, converting if necessary. """
-    if source_mimetype == target_mimetype:
+def copy_or_convert(source: Path, target: Path, source_mimetype: str, target_mimetype: str, width: int = None, animated: bool = False):
+    """ Copy source to target, converting and resizing if necessary.
+
+    :param animated: convert all frames of an animated source, instead of only the first one.
+    """
+    if source_mimetype == target_mimetype and width is None:
         logging.info('%s -> %s', source, target)
         shutil.copyfile(source, target)
         return
@@ -38,17 +126,267 @@ def copy_or_convert(source: Path, target: Path, source_mimetype: str, target_mim
     target_kind = target_mimetype.split('/')[0]
     if source_kind != target_kind:
         raise NotImplementedError(f'cannot convert {source_kind} {source}  to  {target_kind} {target}')
-    if source_kind == 'image':
+    if source_kind == 'image' and animated:
         logging.info('%s -> %s', source, target)
-        convert_image(source, target, source_mimetype, target_mimetype)
+        convert_animation(source, target, source_mimetype, target_mimetype)
         return target
-    elif source_kind == 'video':
+    if source_kind == 'image':
         logging.info('%s -> %s', source, target)
-        convert_image(source, target, source_mimetype, target_mimetype)
+        convert_image(source, target, source_mimetype, target_mimetype, width)
         return target
+    # video is only copied as is; short animated works are published as animated images instead
     raise NotImplementedError(f'cannot convert {source_mimetype} {source}  to  {target_mimetype} {target}')
 
 
+@dataclasses.dataclass(frozen=True)
+class ConversionJob:
+    """ A single copy or conversion of a source file to a target file. """
+    source: Path
+    target: Path
+    source_mimetype: str
+    target_mimetype: str
+    width: int | None = None
+    """ scale images down to this width """
+    animated: bool = False
+    """ the source image is animated """
+    poster: bool = False
+    """ convert only the first frame of an animated source, as a still image """
+
+    @property
+    def is_copy(self) -> bool:
+        return self.source_mimetype == self.target_mimetype and self.width is None and not self.poster
+
+    @property
+    def is_animation(self) -> bool:
+        """ whether all frames of the source are converted """
+        return self.animated and not self.poster
+
+    @property
+    def parameters(self) -> tuple[str, ...]:
+        """ all settings that affect the output of this job. """
+        if self.is_copy:
+            return 'copy',
+        parameters = (self.source_mimetype, self.target_mimetype, f'width={self.width}', f'quality={CONFIG.image_quality}')
+        if self.target_mimetype == 'image/jpeg':
+            parameters += (f'background_color={CONFIG.background_color}',)
+        if self.animated:
+            parameters += ('poster' if self.poster else 'animation',)
+        return parameters
+
+    def inputs_digest(self, manifest: Manifest = None) -> str:
+        """ digest of the source contents and parameters, which identifies the output. """
+        return digest(manifest.file_digest(self.source) if manifest else file_digest(self.source), *self.parameters)
+
+    def run(self) -> Path:
+        self.target.parent.mkdir(parents=True, exist_ok=True)
+        copy_or_convert(self.source, self.target, self.source_mimetype, self.target_mimetype, self.width, self.is_animation)
+        return self.target
+
+
+def run_batch(jobs: list[ConversionJob], placeholder_key: str = None, source: Path = None) -> list[BaseException | None]:
+    """ Run jobs that share a source, decoding the source image at most once.
+
+        Image conversions are done largest width first, each derivative being scaled down from the previous one.
+        Animations are converted from their own decoder, frame by frame; the first frame decoded for still
+        conversions of the same source (e.g. its poster) is kept. If none of the still conversions is full-size,
+        the source is decoded at a reduced resolution (see open_image).
+
+        :param placeholder_key: if given, also make the placeholder of the source and add it to PLACEHOLDERS,
+          from the smallest derivative, or by decoding the source at a small size if there are no still conversions.
+        :param source: the shared source, if there are no jobs.
+        :returns: for each job, the exception it raised or None if it succeeded.
+    """
+    errors: dict[ConversionJob, BaseException | None] = {}
+    img = None
+    decode_width = max_decode_width(jobs)
+    try:
+        for job in sorted(jobs, key=lambda job: (job.width is None, job.width or 0), reverse=True):
+            with TRACER.span(os.path.relpath(job.source, CONFIG.root_dir), 'convert', mimetype=job.target_mimetype, width=job.width) as span:
+                try:
+                    if job.is_copy or job.is_animation or not job.source_mimetype.startswith('image/'):
+                        job.run()
+                    else:
+                        if img is None:
+                            with TRACER.span(os.path.relpath(job.source, CONFIG.root_dir), 'decode', width=decode_width):
+                                img = open_image(job.source, decode_width)
+                        img = resize_to_width(img, job.width)
+                        logging.info('%s -> %s', job.source, job.target)
+                        job.target.parent.mkdir(parents=True, exist_ok=True)
+                        save_image(img, job.target, job.target_mimetype)
+                    errors[job] = None
+                    if TRACER.enabled:
+                        span.update(bytes_in=job.source.stat().st_size, bytes_out=job.target.stat().st_size)
+                except Exception as e:
+                    errors[job] = e
+                    span['error'] = str(e)
+        if placeholder_key is not None:
+            source = source or jobs[0].source
+            with TRACER.span(os.path.relpath(source, CONFIG.root_dir), 'placeholder'):
+                try:
+                    if img is None:
+                        img = open_image(source, PLACEHOLDER_WIDTH)
+                    PLACEHOLDERS.put(placeholder_key, make_placeholder(img, CONFIG.image_placeholders))
+                except Exception as e:
+                    logging.warning('cannot make placeholder for %s: %s', source, e)
+                    PLACEHOLDERS.put(placeholder_key, '')
+    finally:
+        if img is not None:
+            img.close()
+    return [errors[job] for job in jobs]
+
+
+def is_still_conversion(job: ConversionJob) -> bool:
+    """ whether run_batch converts the job from the shared decoded image. """
+    return not job.is_copy and not job.is_animation and job.source_mimetype.startswith('image/')
+
+
+def max_decode_width(jobs: Iterable[ConversionJob]) -> int | None:
+    """ the width the shared source image of a batch must be decoded at, or None for its full size. """
+    widths = [job.width for job in jobs if is_still_conversion(job)]
+    if not widths or None in widths:
+        return None
+    return max(widths)
+
+
+def estimate_memory(jobs: list[ConversionJob]) -> int:
+    """ estimated peak memory in bytes of run_batch(jobs): the decoded source and one scaled or flattened copy. """
+    if not any(is_still_conversion(job) or job.is_animation for job in jobs):
+        return 0
+    info = IMAGE_INDEX.get(jobs[0].source)
+    if info is None:
+        return 0
+    pixels = info.width * info.height
+    if decode_width := max_decode_width(jobs):
+        pixels //= max(1, info.width // decode_width) ** 2
+    return 2 * 4 * pixels
+
+
+def _init_conversion_worker(config: Config, tracing: bool) -> None:
+    configure(config)
+    init_worker(tracing)
+
+
+def _run_batch_in_worker(jobs: list[ConversionJob], placeholder_key: str | None, source: Path) -> tuple[list[BaseException | None], list[dict], dict[str, str]]:
+    """ run_batch in a worker process; also returns the trace events and new placeholders. """
+    return run_batch(jobs, placeholder_key, source), TRACER.take_events(), PLACEHOLDERS.take_changes()
+
+
+def store_path(inputs_digest: str) -> Path:
+    """ path of a conversion output in the content-addressed store in the build directory. """
+    return CONFIG.build_dir / 'store' / inputs_digest[:2] / inputs_digest
+
+
+def prune_store(manifest: Manifest) -> None:
+    """ remove conversion outputs from the store that no output recorded in the manifest was built from. """
+    store_dir = CONFIG.build_dir / 'store'
+    if not store_dir.is_dir():
+        return
+    recorded = set(manifest.outputs.values())
+    for path in store_dir.glob('*/*'):
+        if path.name.split('.')[0] not in recorded:
+            logging.info('x %s', path)
+            path.unlink()
+
+
+def run_jobs(jobs: Iterable[ConversionJob], manifest: Manifest | None = None, max_workers: int | None = None,
+             dry_run: bool = False) -> dict[ConversionJob, BaseException]:
+    """ Run conversion jobs on a process pool, skipping duplicate targets.
+
+        Outputs go through a content-addressed store, keyed by the digest of the source and conversion parameters:
+        each distinct conversion is done once, into the store, and hardlinked to every target that needs it.
+        A failing job does not stop the other jobs. Fewer batches run in parallel while large images are being
+        converted, to keep their estimated memory within CONFIG.conversion_memory_per_worker per worker.
+        The placeholders of sources that have none yet are made along the way (see run_batch).
+
+        :param manifest: if given, skip jobs whose target is up-to-date according to the manifest, and record finished jobs.
+        :param max_workers: number of worker processes. Defaults to the number of CPUs; 1 runs all jobs in this process.
+        :param dry_run: only list the targets that would be written.
+        :returns: failed jobs mapped to the exception they raised.
+    """
+    unique_jobs: dict[Path, ConversionJob] = {}
+    for job in jobs:
+        if (other := unique_jobs.setdefault(job.target, job)) != job:
+            logging.warning('conflicting sources for %s: %s and %s', job.target, other.source, job.source)
+    pending: dict[ConversionJob, str] = {}
+    for job in unique_jobs.values():
+        inputs_digest = job.inputs_digest(manifest)
+        if manifest is None or not manifest.is_up_to_date(job.target, inputs_digest):
+            pending[job] = inputs_digest
+    if dry_run:
+        for job in pending:
+            report_planned(job.target, 'copy' if job.is_copy else 'convert')
+        return {}
+
+    # one conversion per digest missing from the store, written to a temporary file with the target's suffix
+    errors: dict[str, BaseException | None] = {}
+    conversions: dict[ConversionJob, str] = {}
+    for job, inputs_digest in pending.items():
+        stored = store_path(inputs_digest)
+        if inputs_digest not in errors and not stored.exists():
+            errors[inputs_digest] = None
+            conversions[dataclasses.replace(job, target=stored.with_name(f'{stored.name}.tmp{job.target.suffix}'))] = inputs_digest
+
+    def finish(job: ConversionJob, e: BaseException | None):
+        errors[conversions[job]] = e
+        if e is None:
+            os.replace(job.target, store_path(conversions[job]))
+
+    batches: dict[Path, list[ConversionJob]] = {}
+    for job in conversions:
+        batches.setdefault(job.source, []).append(job)
+    # placeholders of all sources are made along with their conversions, or on their own if the outputs are up-to-date
+    placeholder_keys: dict[Path, str] = {}
+    for job in unique_jobs.values():
+        if job.source not in placeholder_keys and job.source_mimetype.startswith('image/') and (key := PLACEHOLDERS.missing_key(job.source)):
+            placeholder_keys[job.source] = key
+            batches.setdefault(job.source, [])
+
+    if max_workers == 1 or len(batches) <= 1:
+        for source, batch in batches.items():
+            for job, e in zip(batch, run_batch(batch, placeholder_keys.get(source), source)):
+                finish(job, e)
+    else:
+        # batches are submitted while their estimated memory fits the budget of all workers together; a batch larger
+        # than that runs once nothing else is running
+        max_workers = max_workers or os.cpu_count() or 1
+        budget = CONFIG.conversion_memory_per_worker * max_workers << 20
+        queue = sorted(((estimate_memory(batch), source, batch) for source, batch in batches.items()), key=lambda item: item[0], reverse=True)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_conversion_worker, initargs=(CONFIG, TRACER.enabled)) as executor:
+            futures: dict[concurrent.futures.Future, tuple[list[ConversionJob], int]] = {}
+            in_use = 0
+            while queue or futures:
+                while queue and (not futures or not budget or in_use + queue[0][0] <= budget):
+                    memory, source, batch = queue.pop(0)
+                    futures[executor.submit(_run_batch_in_worker, batch, placeholder_keys.get(source), source)] = batch, memory
+                    in_use += memory
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    batch, memory = futures.pop(future)
+                    in_use -= memory
+                    if future.exception():
+                        batch_errors = [future.exception()] * len(batch)
+                    else:
+                        batch_errors, events, placeholders = future.result()
+                        TRACER.add_events(events)
+                        PLACEHOLDERS.update(placeholders)
+                    for job, e in zip(batch, batch_errors):
+                        finish(job, e)
+
+    failures: dict[ConversionJob, BaseException] = {}
+    for job, inputs_digest in pending.items():
+        if (e := errors.get(inputs_digest)) is not None:
+            failures[job] = e
+            logging.error('failed to convert %s -> %s: %s', job.source, job.target, e)
+            if manifest:
+                manifest.forget(job.target)
+            continue
+        job.target.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(store_path(inputs_digest), job.target)
+        if manifest:
+            manifest.record(job.target, inputs_digest)
+    return failures
+
+
 @dataclasses.dataclass(eq=True)
 class Asset:
     """ Represents a single media object, which may come in multiple formats. """
@@ -63,29 +401,35 @@ class Asset:
             :returns: (source, mimetype)
         """
         candidates = (self.source.with_suffix(ext) for ext in mimetypes.guess_all_extensions(target_mimetype))
-        if p := next((p for p in candidates if p.exists()), None):
+        if p := next((p for p in candidates if SOURCE_INDEX.exists(p)), None):
             return p, target_mimetype
         if target_mimetype.startswith('image/'):
-            candidates = (self.source.with_suffix(ext) for ext in ('.png', '.jpg', '.jpeg', '.webp'))  # look for lossless formats first
-            if p := next((p for p in candidates if p.exists()), None):
+            candidates = (self.source.with_suffix(ext) for ext in ('.png', '.jpg', '.jpeg', '.webp', '.gif'))  # look for lossless formats first
+            if p := next((p for p in candidates if SOURCE_INDEX.exists(p)), None):
                 return p, mimetypes.guess_type(p)[0]
         elif target_mimetype.startswith('video/'):
             pass
         raise FileNotFoundError(f'no source file found for {self.source} matching mimetype {target_mimetype}')
 
-    def to(self, target: Path, mimetype=None) -> Path:
-        """ copy source to target if source is newer than target, converting if necessary """
+    def job(self, target: Path, mimetype=None, width: int = None, poster: bool = False) -> ConversionJob:
+        """ job to copy source to target, converting and scaling down to `width` if necessary.
+
+        :param poster: convert only the first frame if the source is animated.
+        """
         if mimetype is None:
             mimetype = mimetypes.guess_type(target)[0]
         source, source_mimetype = self._find_best_source(mimetype)
-        if not is_up_to_date(source, target):
-            copy_or_convert(source, target, source_mimetype, mimetype)
+        info = IMAGE_INDEX.get(source) if source_mimetype.startswith('image/') else None
+        return ConversionJob(source, target, source_mimetype, mimetype, width, animated=info is not None and info.animated, poster=poster)
+
+    def to(self, target: Path, mimetype=None, manifest: Manifest = None) -> Path:
+        """ copy source to target if the manifest says it is outdated, converting if necessary """
+        run_jobs([self.job(target, mimetype)], manifest=manifest, max_workers=1)
         return target
 
-    def to_dir(self, directory: Path, mimetype: str = 'image/*') -> Path:
-        """ copy source to directory if source is newer than target, converting if necessary """
+    def to_dir(self, directory: Path, mimetype: str = 'image/*', manifest: Manifest = None) -> Path:
+        """ copy source to directory if the manifest says it is outdated, converting if necessary """
         source, source_mimetype = self._find_best_source(mimetype)
         target = directory / (source.stem + (mimetypes.guess_extension(mimetype) or source.suffix))
-        if not is_up_to_date(source, target):
-            copy_or_convert(source, target, source_mimetype, mimetype)
+        run_jobs([ConversionJob(source, target, source_mimetype, mimetype)], manifest=manifest, max_workers=1)
         return target
@@ -0,0 +1,225 @@
+#!/bin/env python3
+""" benchmark the builder on a generated corpus.
+
+Generates N projects and pieces with M images each in a temporary directory with its own config.ini,
+then times each build phase for a cold build (empty build and output directories) and a warm build
+(everything up-to-date), and writes the results as JSON, e.g. to compare commits:
+
+    python3 builder/benchmark.py --pieces 200 --images 3 -o before.json
+
+Every build runs in a separate process, so no state carries over between builds.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BUILDER_DIR = Path(__file__).parent
+SOURCE_DIR = BUILDER_DIR.parent / 'source'
+
+WORDS = ('acrylic', 'canvas', 'chair', 'dog', 'night', 'landscape', 'soft', 'light', 'paper', 'ink', 'wood',
+         'performance', 'sculpture', 'colour', 'the', 'a', 'of', 'and', 'with', 'in')
+
+CONFIG_TEMPLATE = """\
+[paths]
+build = build
+output = generated
+input = source
+static = ${input}/images ${input}/style
+projects = ${input}/projects
+pieces = ${input}/pieces
+templates = ${input}/templates
+homepage = ${input}/homepage
+
+[conversion]
+background_color = #ffffff
+widths = %(widths)s
+quality = 80
+"""
+
+
+def sentence(rng: random.Random, n_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + '.'
+
+
+def generate_markdown(rng: random.Random, title: str, image_names: list[str], paragraphs: int) -> str:
+    lines = []
+    if image_names:
+        lines.append(f'![{title}]({image_names[0]}){{.headline}}')
+    lines += [f'# {title}', '']
+    for i in range(paragraphs):
+        lines += [' '.join(sentence(rng, rng.randint(5, 20)) for _ in range(rng.randint(2, 6))), '']
+        if i + 1 < len(image_names):
+            lines += [f'![{title} {i + 1}]({image_names[i + 1]})', '']
+    lines += [f'![{title} {i}]({name})\n' for i, name in enumerate(image_names[paragraphs + 1:], paragraphs + 1)]
+    return '\n'.join(lines)
+
+
+def generate_image(path: Path, size: tuple[int, int], seed: int) -> None:
+    import PIL.Image
+    # noise over a gradient, so images neither compress to nothing nor all look alike
+    rng = random.Random(seed)
+    gradient = PIL.Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size)
+    noise = PIL.Image.effect_noise(size, rng.randint(16, 64))
+    tint = PIL.Image.new('L', size, rng.randrange(256))
+    image = PIL.Image.merge('RGB', (gradient, noise, tint))
+    if path.suffix == '.png':
+        image.putalpha(gradient)
+    image.save(path)
+
+
+def generate_corpus(root: Path, projects: int, pieces: int, images: int, image_size: tuple[int, int],
+                    image_format: str, paragraphs: int, widths: list[int], seed: int = 0) -> Path:
+    """ write a corpus and its config.ini to root, and return the config path. """
+    rng = random.Random(seed)
+    source = root / 'source'
+    for kind, count in (('projects', projects), ('pieces', pieces)):
+        for i in range(count):
+            slug = f'{kind[:-1]}-{i:05d}'
+            directory = source / kind / slug
+            directory.mkdir(parents=True)
+            image_names = [f'{slug}-{j}.{image_format}' for j in range(images)]
+            for image_name in image_names:
+                generate_image(directory / image_name, image_size, rng.randrange(1 << 32))
+            title = sentence(rng, rng.randint(1, 4))[:-1]
+            n_paragraphs = rng.randint(max(0, paragraphs // 2), paragraphs + paragraphs // 2)
+            (directory / f'{slug}.md').write_text(generate_markdown(rng, title, image_names, n_paragraphs))
+    (source / 'homepage').mkdir(parents=True)
+    (source / 'homepage' / 'about.md').write_text('\n\n'.join(sentence(rng, 12) for _ in range(paragraphs)))
+    for name in ('templates', 'style', 'images'):
+        shutil.copytree(SOURCE_DIR / name, source / name)
+    config_path = root / 'config.ini'
+    config_path.write_text(CONFIG_TEMPLATE % dict(widths=' '.join(map(str, widths))))
+    return config_path
+
+
+def time_phases(config_path: Path, max_workers: int = None) -> dict[str, float]:
+    """ run a full build with the given config in this process, like build.py --sync-static, and return the time of
+    each phase as recorded by the tracer, and of markdown parsing ('parse') and page rendering ('render') within them. """
+    import build
+    from config import load_config
+    from imageinfo import IMAGE_INDEX
+    from manifest import Manifest
+    from optimize import STYLE_CACHE
+    from placeholders import PLACEHOLDERS
+    from tracing import TRACER
+
+    load_config(config_path)
+    TRACER.enabled = True
+    args = argparse.Namespace(should_build_project_pages=True, should_build_piece_pages=True, should_update_gallery=True,
+                              should_sync_static=True, should_parallelize_pages=False, should_compress=False,
+                              dry_run=False, jobs=max_workers)
+    manifest = Manifest.load()
+    with TRACER.span('discovery', 'phase'):
+        projects, pieces = build.discover_resources()
+    try:
+        failures = build.build(projects, pieces, manifest, args)
+    finally:
+        manifest.save()
+        IMAGE_INDEX.save()
+        PLACEHOLDERS.save()
+        STYLE_CACHE.save()
+    if failures:
+        raise RuntimeError(f'{len(failures)} asset conversions failed')
+    timings = {}
+    for event in TRACER.events:
+        if event['cat'] == 'phase':
+            timings[event['name']] = timings.get(event['name'], 0) + event['dur'] / 1e6
+    timings['total'] = sum(timings.values())
+    for category in ('parse', 'render'):
+        timings[category] = sum(event['dur'] for event in TRACER.events if event['cat'] == category) / 1e6
+    return timings
+
+
+def run_build(config_path: Path, jobs: int | None) -> dict[str, float]:
+    """ time a build in a new process, so no state carries over between builds. """
+    command = [sys.executable, __file__, '-c', str(config_path), '--run-phases']
+    if jobs:
+        command += ['-j', str(jobs)]
+    start = time.perf_counter()
+    output = subprocess.run(command, cwd=config_path.parent, check=True, stdout=subprocess.PIPE, text=True).stdout
+    timings = json.loads(output)
+    timings['process'] = time.perf_counter() - start
+    return timings
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BUILDER_DIR, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args) -> dict:
+    width, height = args.image_size
+    corpus = dict(projects=args.projects, pieces=args.pieces, images=args.images, image_size=[width, height],
+                  image_format=args.image_format, paragraphs=args.paragraphs, widths=args.widths)
+    root = Path(args.keep) if args.keep else Path(tempfile.mkdtemp(prefix='builder-benchmark-'))
+    try:
+        start = time.perf_counter()
+        config_path = generate_corpus(root, **corpus)
+        generation_time = time.perf_counter() - start
+        runs = dict(cold=[], warm=[])
+        for _ in range(args.repeat):
+            shutil.rmtree(root / 'build', ignore_errors=True)
+            shutil.rmtree(root / 'generated', ignore_errors=True)
+            runs['cold'].append(run_build(config_path, args.jobs))
+            runs['warm'].append(run_build(config_path, args.jobs))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    return dict(
+        revision=git_revision(),
+        python=platform.python_version(),
+        cpu_count=os.cpu_count(),
+        jobs=args.jobs,
+        corpus=corpus,
+        generation_time=generation_time,
+        runs=runs,
+        # peak resident set size of the largest build process: the maximum over all children, not their sum
+        max_rss_kib=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        # phases that did not run in some builds (e.g. placeholders in warm builds) count as 0
+        best={kind: {key: min(run.get(key, 0.0) for run in kind_runs) for key in dict.fromkeys(k for run in kind_runs for k in run)}
+              for kind, kind_runs in runs.items()},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--projects', type=int, default=20, help='number of projects')
+    parser.add_argument('--pieces', type=int, default=100, help='number of pieces')
+    parser.add_argument('--images', type=int, default=2, help='images per project or piece')
+    parser.add_argument('--image-size', type=lambda s: tuple(map(int, s.split('x'))), default=(1600, 1200), help='WIDTHxHEIGHT of the generated images')
+    parser.add_argument('--image-format', choices=('jpg', 'png', 'webp'), default='jpg')
+    parser.add_argument('--paragraphs', type=int, default=4, help='average number of paragraphs per description')
+    parser.add_argument('--widths', type=int, nargs='+', default=[320, 640, 1280], help='derivative widths (conversion.widths in the config)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of cold and warm builds')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of parallel asset conversions')
+    parser.add_argument('--keep', metavar='DIR', help='generate the corpus in DIR and keep it, instead of in a temporary directory')
+    parser.add_argument('-o', '--output', type=Path, help='write results to this file instead of stdout')
+    parser.add_argument('--run-phases', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('-c', '--config', type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_phases:
+        json.dump(time_phases(args.config, max_workers=args.jobs), sys.stdout)
+        return
+    results = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        args.output.write_text(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,174 +1,895 @@
 #!/bin/env python3
 from __future__ import annotations
 
+import concurrent.futures
+import dataclasses
 import datetime
 import functools
 import itertools
+import json
 import logging
 import os
 import re
 import shutil
-import xml.etree.ElementTree as ET
+import time
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable, Iterator
 
-import jinja2
-import markupsafe
+from assets import Asset, ConversionJob, prune_store, run_jobs
+from compress import COMPRESSORS, compress_outputs
+from document import Document, PARSE_CACHE, get_markdown_parser
+from imageinfo import IMAGE_INDEX
+from placeholders import PLACEHOLDERS
+from manifest import Manifest, digest, file_digest
+from optimize import STYLE_CACHE, critical_css, inline_critical_css, markup_vocabulary, minify_css, minify_html
+from resources import GalleryRecord, Resource, Piece, Project
+from search import build_search_index
+from sourceindex import SOURCE_INDEX, SourceIndex
+from config import CONFIG, Config, configure, load_config
+from tracing import TRACER, init_worker
+from util import link_or_copy, report_planned, split_fingerprint, split_poster, split_width, scan_tree, with_fingerprint, write_atomic
 
-from assets import Asset
-from document import Document, markdown_parser
-from resources import Resource, Piece, Project
-from config import CONFIG
+if TYPE_CHECKING:
+    import jinja2
 
-jinja_environment = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(CONFIG.templates_dir)
-)
 
-# Add zero width spaces around sequences of non-alphanumerical characters in sequences of alphanumerical characters.
-# e.g. 'tekeningen/schilderijen' -> 'tekeningen[ZWSP]/[ZWSP]schilderijen'
-jinja_environment.filters['morebreaks'] = functools.partial(re.sub, re.compile(r"(\w{2,})([^\w\s'-]+)(\w{2,})"), r'\1​\2​\3')
+@functools.cache
+def get_jinja_environment() -> jinja2.Environment:
+    """ the template environment, created on first use so that runs without page rendering do not import jinja2. """
+    import jinja2
+    jinja_environment = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(CONFIG.templates_dir)
+    )
 
+    # Add zero width spaces around sequences of non-alphanumerical characters in sequences of alphanumerical characters.
+    # e.g. 'tekeningen/schilderijen' -> 'tekeningen[ZWSP]/[ZWSP]schilderijen'
+    jinja_environment.filters['morebreaks'] = functools.partial(re.sub, re.compile(r"(\w{2,})([^\w\s'-]+)(\w{2,})"), r'\1​\2​\3')
+    jinja_environment.globals['asset_url'] = asset_url
+    return jinja_environment
 
-def build_resource(resource: Resource) -> Path:
-    page_template = jinja_environment.get_template(f'resource_page.html')
-    page_dir = CONFIG.output_dir / resource.DIRECTORY / resource.slug
-    page_file = page_dir / 'index.html'
-    description = resource.description
-    page = page_template.render(
-        title=description.title,
-        content=description.inner_html()
-    )
 
-    logging.info('%s -> %s', resource.slug, page_file)
-    page_dir.mkdir(exist_ok=True, parents=True)
-    page_file.write_text(page)
+def output_url(path: Path) -> str:
+    """ absolute url of a file in the output directory. """
+    return '/' + path.relative_to(CONFIG.output_dir).as_posix()
+
+
+@functools.cache
+def _static_file_digest(path: Path, size: int, mtime_ns: int) -> str:
+    return file_digest(path)
+
+
+def static_digest(path: Path, stat: os.stat_result = None) -> str:
+    """ content digest of a static source file, cached by size and mtime. """
+    stat = stat or path.stat()
+    return _static_file_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+def static_fingerprint(path: Path, stat: os.stat_result = None) -> str:
+    """ content digest of a static source file as it is published (see publish_static). """
+    content_digest = static_digest(path, stat)
+    return digest(content_digest, 'minified') if is_minified(path) else content_digest
+
+
+def is_minified(path: Path) -> bool:
+    """ whether the static file at path is published minified. """
+    return CONFIG.minify and path.suffix == '.css'
+
+
+def minified_stylesheet(path: Path) -> str:
+    """ the minified content of a stylesheet, cached by its content digest. """
+    return STYLE_CACHE.get(digest('minified', static_digest(path)), lambda: minify_css(path.read_text()))
+
+
+def publish_static(src: Path, dst: Path) -> None:
+    """ link or copy a static file to dst or, if it is minified, write its minified content with the mtime of src. """
+    if not is_minified(src):
+        link_or_copy(src, dst)
+        return
+    stat = src.stat()
+    write_atomic(dst, minified_stylesheet(src))
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    logging.info('%s -> %s (minified)', src, dst)
+
+
+def asset_url(url: str) -> str:
+    """ template function: url of a static file, content-hashed if CONFIG.fingerprint_assets is set.
+
+    The fingerprinted name is linked to the file in the output directory, so it works without --sync-static.
+    """
+    if not CONFIG.fingerprint_assets:
+        return url
+    source = CONFIG.input_dir / url.lstrip('/')
+    target = with_fingerprint(CONFIG.output_dir / url.lstrip('/'), static_fingerprint(source))
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        publish_static(source, target)
+    return output_url(target)
+
+
+def publish_template_assets(*names: str) -> None:
+    """ publish the fingerprinted static files referenced by the given templates (see asset_url), e.g. once in the
+    main process, so that page workers find them published instead of all publishing them at the same time. """
+    for name in names:
+        for path in template_asset_paths(name):
+            if SOURCE_INDEX.exists(path):
+                asset_url('/' + path.relative_to(CONFIG.input_dir).as_posix())
+
+
+@functools.cache
+def builder_digest() -> str:
+    """ digest of the builder source code, so changes to the builder invalidate all generated pages. """
+    return digest(*(p.read_bytes() for p in sorted(Path(__file__).parent.glob('*.py'))))
+
+
+@functools.cache
+def template_paths(name: str) -> tuple[Path, ...]:
+    """ paths of a template and all templates it extends, includes or imports, recursively. """
+    import jinja2.meta
+    jinja_environment = get_jinja_environment()
+    source, filename, _ = jinja_environment.loader.get_source(jinja_environment, name)
+    paths = [Path(filename)]
+    for referenced_name in jinja2.meta.find_referenced_templates(jinja_environment.parse(source)):
+        if referenced_name is None:
+            logging.warning('cannot track dynamic template reference in %s', name)
+            continue
+        paths.extend(p for p in template_paths(referenced_name) if p not in paths)
+    return tuple(paths)
+
+
+P_ASSET_URL = re.compile(r"""asset_url\(\s*['"]([^'"]+)['"]\s*\)""")
+
+
+@functools.cache
+def template_asset_paths(name: str) -> tuple[Path, ...]:
+    """ static files referenced with a literal asset_url('...') in a template and all templates it references. """
+    urls = (url for path in template_paths(name) for url in P_ASSET_URL.findall(path.read_text()))
+    return tuple(dict.fromkeys(CONFIG.input_dir / url.lstrip('/') for url in urls))
+
+
+def template_stylesheets(name: str) -> list[Path]:
+    """ the existing stylesheets referenced with asset_url in a template and all templates it references. """
+    return [path for path in template_asset_paths(name) if path.suffix == '.css' and SOURCE_INDEX.exists(path)]
+
+
+def template_inputs(name: str) -> list[Path]:
+    """ the templates a template depends on and, when fingerprinting asset urls, the static files it references
+    (or only its stylesheets, when inlining critical css). """
+    inputs = list(template_paths(name))
+    if CONFIG.fingerprint_assets:
+        inputs += [path for path in template_asset_paths(name) if SOURCE_INDEX.exists(path)]
+    elif CONFIG.critical_css:
+        inputs += template_stylesheets(name)
+    return inputs
+
+
+GENERATED_CLASSES = frozenset({'.headline'})
+""" selectors of the classes the builder adds to page content (see document.process_headline_image) """
+
+
+@functools.cache
+def template_vocabulary(name: str) -> frozenset[str]:
+    """ class and id selectors used in a template and all templates it references, and those in GENERATED_CLASSES. """
+    return frozenset(markup_vocabulary(''.join(path.read_text() for path in template_paths(name)))) | GENERATED_CLASSES
+
+
+def template_critical_css(name: str, href: str) -> str:
+    """ the rules of the stylesheet linked as href that may apply to the pages of a template (see optimize.critical_css),
+    or '' if href is not one of the template's stylesheets.
+
+    Rules for classes that only appear in the content of some pages are left to the deferred stylesheets.
+    Cached by the template's vocabulary and the contents of the stylesheet.
+    """
+    path = Path(href.lstrip('/'))
+    path = CONFIG.input_dir / path.with_stem(split_fingerprint(path.stem))
+    if path not in template_stylesheets(name):
+        return ''
+    vocabulary = template_vocabulary(name)
+    key = digest('critical', *sorted(vocabulary), static_digest(path))
+    return STYLE_CACHE.get(key, lambda: critical_css(minified_stylesheet(path), vocabulary))
+
+
+def page_options() -> tuple[str, ...]:
+    """ the options that change the markup of pages, for their inputs digests. """
+    return (f'minify={CONFIG.minify}', f'critical_css={CONFIG.critical_css}', f'widths={",".join(map(str, CONFIG.image_widths))}',
+            f'placeholders={CONFIG.image_placeholders}')
+
+
+def optimize_page(html: str, template_name: str) -> str:
+    """ inline the critical css of the template a page was rendered from, and minify it, as configured. """
+    with TRACER.span(template_name, 'optimize'):
+        if CONFIG.critical_css:
+            html = inline_critical_css(html, functools.partial(template_critical_css, template_name))
+        if CONFIG.minify:
+            html = minify_html(html)
+    return html
+
+
+def is_up_to_date(manifest: Manifest | None, output: Path, inputs_digest: str) -> bool:
+    if manifest is None or not manifest.is_up_to_date(output, inputs_digest):
+        return False
+    logging.debug('%s is up to date', output)
+    return True
+
+
+def resource_page_path(resource: Resource) -> Path:
+    return CONFIG.output_dir / resource.DIRECTORY / resource.slug / 'index.html'
+
+
+def build_resource(resource: Resource, manifest: Manifest = None, assets: Iterable[Path] = (), urls: dict[str, str] = None,
+                   dry_run: bool = False) -> Path:
+    """ render the resource page, unless its description, templates and assets are unchanged since the last build.
+
+    The placeholders of the page's images are part of its inputs. A page rendered before they are all known is not
+    recorded as up-to-date, so that it is rendered again once they are (see build).
+
+    :param assets: asset source files the page depends on.
+    :param urls: fingerprinted asset urls by absolute url, to replace references in the description with.
+    :param dry_run: only list the page if it would be written.
+    """
+    page_template = get_jinja_environment().get_template(f'resource_page.html')
+    page_file = resource_page_path(resource)
+    page_dir = page_file.parent
+    with TRACER.span(f'{resource.DIRECTORY}/{resource.slug}', 'page') as span:
+        if manifest is not None:
+            assets = list(dict.fromkeys(assets))
+            placeholders = [PLACEHOLDERS.get(IMAGE_INDEX.get(path)) or '' for path in assets]
+            if resource.description_path:
+                inputs = [resource.description_path, *template_inputs(page_template.name), *assets]
+                inputs_digest = manifest.inputs_digest(inputs, builder_digest(), *page_options(), *placeholders, *sorted((urls or {}).values()))
+            else:
+                # generated description depends only on which assets exist
+                inputs = [*template_inputs(page_template.name), *assets]
+                inputs_digest = manifest.inputs_digest(inputs, builder_digest(), *page_options(), *placeholders, *sorted((urls or {}).values()), *sorted(p.name for p in resource.asset_paths))
+            if is_up_to_date(manifest, page_file, inputs_digest):
+                span['cache'] = 'hit'
+                return page_file
+        if dry_run:
+            report_planned(page_file)
+            return page_file
+        description = resource.description
+        rewrite_url = (lambda url: urls.get(resource.absolute_url(url), url)) if urls else None
+        with TRACER.span(page_template.name, 'render'):
+            page = page_template.render(
+                title=description.title,
+                preload=description.preload_html(rewrite_url),
+                content=description.inner_html(rewrite_url)
+            )
+        page = optimize_page(page, page_template.name)
+
+        logging.info('%s -> %s', resource.slug, page_file)
+        page_dir.mkdir(exist_ok=True, parents=True)
+        write_atomic(page_file, page)
+        span.update(cache='miss', bytes_out=len(page))
+        if manifest is not None and description.pending_placeholders:
+            manifest.forget(page_file)
+        elif manifest is not None:
+            manifest.record(page_file, inputs_digest, inputs)
+    return page_file
+
+
+def remove_stale_outputs(resource: Resource, jobs: Iterable[ConversionJob], manifest: Manifest = None, dry_run: bool = False) -> None:
+    """ remove files from the page directory of a resource that are neither its page nor the target of one of its
+    conversion jobs, e.g. derivatives of widths that are no longer configured or of removed images.
+
+    A dry run does not probe new or changed images, so it does not know all of their derivatives (e.g. whether the
+    original is kept at full size), and plans no removals for resources with such images.
+    """
+    page_file = resource_page_path(resource)
+    jobs = list(jobs)
+    keep = {page_file, *(job.target for job in jobs)}
+    if not page_file.parent.is_dir():
+        return
+    if dry_run and not all(IMAGE_INDEX.is_indexed(job.source) for job in jobs):
+        return
+    for path in sorted(page_file.parent.iterdir()):
+        if path.is_dir() or path in keep or path.suffix in COMPRESSORS and path.with_suffix('') in keep:
+            continue
+        if dry_run:
+            report_planned(path, 'remove')
+            continue
+        logging.info('x %s', path)
+        path.unlink()
+        if manifest is not None:
+            manifest.forget(path)
+
+
+def iter_asset_jobs(resource: Resource, warn: bool = True) -> Iterable[ConversionJob]:
+    """ iterate over the conversions needed to provide all assets the resource page depends on.
+
+    :param warn: log a warning for each missing asset; off when the page was rendered before in the same build.
+    """
+    page_dir = CONFIG.output_dir / resource.DIRECTORY / resource.slug
     assets = {p.stem: Asset(p) for p in resource.asset_paths}
-    for dependency in description.iter_dependencies():
+    missing = set()
+    for dependency in resource.description.iter_dependencies():
         path = Path(dependency.path)
         if not path.is_absolute():
             path = page_dir / path
-        if path.stem in assets:
-            assets[path.stem].to(path)
+        stem, width = (path.stem, None) if path.stem in assets else split_width(path.stem)
+        stem, poster = (stem, False) if stem in assets else split_poster(stem)
+        if stem not in assets:
+            # warn once per image, not for each of its derivatives
+            if warn and stem not in missing:
+                logging.warning('Missing asset %s', path)
+                missing.add(stem)
         else:
-            logging.warning('Missing asset %s', path)
-    return page_file
+            yield assets[stem].job(path, width=width, poster=poster)
+
 
+LAZY_IMAGE_ATTRIBUTES = ' loading="lazy" decoding="async" fetchpriority="low"'
 
-def gallery_item(resource: Resource) -> dict:
-    description = resource.description_with_absolute_urls
-    # TODO: automatically determine this from image dimensions
-    is_wide = 'wide' in description.primary_image.get('class', '').split()
-    picture_html = markupsafe.Markup(re.sub(r'class="[^"]*"', '', ET.tostring(description.primary_image, encoding='unicode')))
+
+def lazy_picture(picture: str) -> str:
+    """ add lazy loading attributes to the img of picture markup serialized by element_html, unless it has them. """
+    if ' loading=' in picture:
+        return picture
+    return picture.replace('<img ', f'<img{LAZY_IMAGE_ATTRIBUTES} ', 1)
+
+
+def gallery_item(record: GalleryRecord, lazy: bool = False) -> dict:
+    """ :param lazy: let the browser defer loading the image until it is scrolled into view. """
+    import markupsafe
     return dict(
-        link=str(Path('/') / resource.DIRECTORY / resource.slug) + '/',
-        title=description.title,
-        picture=picture_html,
-        wide=is_wide
+        link=record.url,
+        title=record.title,
+        picture=markupsafe.Markup(lazy_picture(record.picture) if lazy else record.picture),
+        wide=record.wide
     )
 
 
-def build_resources_index(resources: Iterable[Resource], kind: type[Resource] | str) -> Path:
+def gallery_json_item(record: GalleryRecord) -> dict:
+    """ compact gallery record for the json pages; pictures are always lazy, since they are fetched below the fold. """
+    item = dict(link=record.url, title=record.title, picture=lazy_picture(record.picture), wide=record.wide,
+                width=record.width, height=record.height, date=record.date and record.date.isoformat())
+    return {key: value for key, value in item.items() if value is not None}
+
+
+def gallery_page_url(kind: Path, page: int) -> str:
+    """ url of a gallery index page: /pieces/ for the first page, /pieces/page/2/ for the second, etc. """
+    return f'/{kind.as_posix()}/' if page == 1 else f'/{kind.as_posix()}/page/{page}/'
+
+
+def gallery_order(record: GalleryRecord) -> tuple:
+    """ sort key of gallery records: newest first, undated last, then by slug. """
+    return record.date is None, -record.date.toordinal() if record.date else 0, record.slug
+
+
+def build_resources_index(records: Iterable[GalleryRecord], kind: type[Resource] | str, manifest: Manifest = None,
+                          dry_run: bool = False, clean: bool = False) -> list[Path]:
+    """ render the gallery index pages, unless the templates and the gallery items of a page are unchanged since the last build.
+
+    Items are ordered newest first, then undated ones, and by slug among equal dates, so that the pagination does not
+    depend on the order of the directory listing. They are split into pages of CONFIG.gallery_page_size, at stable
+    urls (see gallery_page_url), and pages beyond the last one are removed. Only the gallery items (title, primary image, link) are taken into account,
+    so editing the body text of a resource does not cause the index to be rebuilt.
+
+    :param dry_run: only list the pages that would be written or removed.
+    :param clean: plan for an empty output directory (--dry-run --clean), with no pages to remove.
+    :returns: the paths of the index pages.
+    """
     kind = Path(getattr(kind, 'DIRECTORY', kind))
-    output_path = CONFIG.output_dir / kind / 'index.html'
-    template = jinja_environment.get_template(f'resource_index.html')
-    page = template.render(items=(gallery_item(r) for r in resources if r.DIRECTORY == kind))
-    logging.info('-> %s', output_path)
-    output_path.write_text(page)
+    records = sorted((r for r in records if r.directory == kind), key=gallery_order)
+    page_size = CONFIG.gallery_page_size or len(records) or 1
+    pages = [records[start:start + page_size] for start in range(0, len(records), page_size)] or [[]]
+    paths = [build_gallery_page(page_records, kind, page, len(pages), manifest, dry_run) for page, page_records in enumerate(pages, 1)]
+    if not clean:
+        remove_gallery_pages(kind, after=len(pages), manifest=manifest, dry_run=dry_run)
+    return paths
+
+
+def build_gallery_page(records: list[GalleryRecord], kind: Path, page: int, pages: int, manifest: Manifest = None,
+                       dry_run: bool = False) -> Path:
+    """ render one gallery index page and, if CONFIG.gallery_json is set, its items as json. """
+    output_path = CONFIG.output_dir / gallery_page_url(kind, page).strip('/') / 'index.html'
+    json_path = output_path.with_suffix('.json')
+    template = get_jinja_environment().get_template(f'resource_index.html')
+    items = [gallery_item(r, lazy=i >= CONFIG.gallery_eager_items) for i, r in enumerate(records)]
+    pagination = dict(
+        page=page,
+        pages=pages,
+        previous=gallery_page_url(kind, page - 1) if page > 1 else None,
+        next=gallery_page_url(kind, page + 1) if page < pages else None,
+        urls=[gallery_page_url(kind, n) for n in range(1, pages + 1)],
+    )
+    with TRACER.span(gallery_page_url(kind, page).strip('/'), 'page', items=len(items)) as span:
+        if manifest is not None:
+            inputs = template_inputs(template.name)
+            item_parameters = (f'{key}={value}' for item in items for key, value in sorted(item.items()))
+            inputs_digest = manifest.inputs_digest(inputs, builder_digest(), *page_options(), f'page={page}/{pages}', f'json={CONFIG.gallery_json}', *item_parameters)
+            if is_up_to_date(manifest, output_path, inputs_digest) and (not CONFIG.gallery_json or is_up_to_date(manifest, json_path, inputs_digest)):
+                span['cache'] = 'hit'
+                return output_path
+        if dry_run:
+            report_planned(output_path)
+            if CONFIG.gallery_json:
+                report_planned(json_path)
+            return output_path
+        with TRACER.span(template.name, 'render'):
+            page_html = template.render(items=items, pagination=pagination)
+        page_html = optimize_page(page_html, template.name)
+        logging.info('-> %s', output_path)
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        write_atomic(output_path, page_html)
+        span.update(cache='miss', bytes_out=len(page_html))
+        if CONFIG.gallery_json:
+            data = dict(page=page, pages=pages, next=pagination['next'] and pagination['next'] + json_path.name,
+                        items=[gallery_json_item(r) for r in records])
+            write_atomic(json_path, json.dumps(data, separators=(',', ':')))
+        else:
+            json_path.unlink(missing_ok=True)
+        if manifest is not None:
+            inputs = [*inputs, *(r.description_path for r in records if r.description_path)]
+            manifest.record(output_path, inputs_digest, inputs)
+            if CONFIG.gallery_json:
+                manifest.record(json_path, inputs_digest, inputs)
+            else:
+                manifest.forget(json_path)
     return output_path
 
 
-def build_homepage(output_path: Path = Path('index.html')) -> Path:
+def remove_gallery_pages(kind: Path, after: int, manifest: Manifest = None, dry_run: bool = False) -> None:
+    """ remove the gallery index pages of kind numbered higher than `after`, e.g. when resources were removed. """
+    pages_dir = CONFIG.output_dir / kind / 'page'
+    if not pages_dir.is_dir():
+        return
+    for page_dir in pages_dir.iterdir():
+        if not page_dir.name.isdigit() or int(page_dir.name) <= after:
+            continue
+        if dry_run:
+            report_planned(page_dir, 'remove')
+            continue
+        logging.info('removing %s', page_dir)
+        shutil.rmtree(page_dir, ignore_errors=True)
+        if manifest is not None:
+            manifest.forget(page_dir / 'index.html')
+            manifest.forget(page_dir / 'index.json')
+    if not dry_run and not any(pages_dir.iterdir()):
+        pages_dir.rmdir()
+
+
+def build_homepage(output_path: Path = Path('index.html'), manifest: Manifest = None, dry_run: bool = False) -> Path:
     output_path = output_path if output_path.is_absolute() else CONFIG.output_dir / output_path
-    template = jinja_environment.get_template('index.html')
+    template = get_jinja_environment().get_template('index.html')
     about_path = CONFIG.homepage_dir / 'about.md'
-    if about_path.exists():
-        about = markdown_parser.convert(about_path.read_text())
-    else:
-        about = ''
-        logging.warning('no about.md found in %s', CONFIG.homepage_dir)
-    page = template.render(about=about)
-    logging.info('-> %s', output_path)
-    output_path.write_text(page)
+    with TRACER.span('homepage', 'page') as span:
+        if manifest is not None:
+            inputs = [*template_inputs(template.name), *([about_path] if SOURCE_INDEX.exists(about_path) else [])]
+            inputs_digest = manifest.inputs_digest(inputs, builder_digest(), *page_options())
+            if is_up_to_date(manifest, output_path, inputs_digest):
+                span['cache'] = 'hit'
+                return output_path
+        if dry_run:
+            report_planned(output_path)
+            return output_path
+        if SOURCE_INDEX.exists(about_path):
+            about = get_markdown_parser().reset().convert(about_path.read_text())
+        else:
+            about = ''
+            logging.warning('no about.md found in %s', CONFIG.homepage_dir)
+        with TRACER.span(template.name, 'render'):
+            page = template.render(about=about)
+        page = optimize_page(page, template.name)
+        logging.info('-> %s', output_path)
+        output_path.parent.mkdir(exist_ok=True, parents=True)
+        write_atomic(output_path, page)
+        span.update(cache='miss', bytes_out=len(page))
+        if manifest is not None:
+            manifest.record(output_path, inputs_digest, inputs)
     return output_path
 
 
-def sync_static_path(src: Path) -> Path:
+def is_synced(src: os.stat_result, dst: os.stat_result, minified: bool = False) -> bool:
+    """ whether dst is the same file as src, or a copy of it made with link_or_copy.
+
+    :param minified: whether dst should be a minified copy instead, made with publish_static: a file with the mtime
+      of src that is not a plain copy of it.
+    """
+    copied = (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino) or (src.st_size, src.st_mtime_ns) == (dst.st_size, dst.st_mtime_ns)
+    if minified:
+        return not copied and src.st_mtime_ns == dst.st_mtime_ns
+    return copied
+
+
+def sync_static_path(src: Path, max_workers: int = None, dry_run: bool = False, clean: bool = False) -> Path:
+    """ make dst (the corresponding path in the output directory) a copy of src.
+
+    Files are hardlinked where possible, and stylesheets are minified if CONFIG.minify is set. For directories, only new and changed files are linked or copied
+    (on a thread pool) and files that no longer exist in src are removed, so an unchanged tree is left untouched.
+
+    :param dry_run: only list the files that would be linked or removed.
+    :param clean: plan for an empty output directory (--dry-run --clean), listing all files as linked.
+    """
     dst = CONFIG.output_dir / src.relative_to(CONFIG.input_dir)
+    with TRACER.span(str(src.relative_to(CONFIG.input_dir)), 'static') as span:
+        _sync_static_path(src, dst, span, max_workers, dry_run, clean)
+    return dst
+
+
+def _sync_static_path(src: Path, dst: Path, span: dict, max_workers: int = None, dry_run: bool = False, clean: bool = False) -> None:
     if src.is_file():
-        if not dst.exists():
-            try:
-                os.link(src, dst)
-                logging.info('%s => %s', src, dst)
-            except OSError:
-                shutil.copy2(src, dst)
-                logging.info('%s -> %s', src, dst)
-        elif dst.samefile(src):
-            pass
-        else:
-            shutil.copy2(src, dst)
-            logging.info('%s -> %s', src, dst)
+        if clean or not dst.exists() or not is_synced(src.stat(), dst.stat(), is_minified(src)):
+            if dry_run:
+                report_planned(dst, 'link')
+                return
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            publish_static(src, dst)
+            span.update(files=1, bytes=src.stat().st_size)
     elif src.is_dir():
-        if not dst.exists():
-            try:
-                shutil.copytree(src, dst, copy_function=os.link)
-                logging.info('%s => %s', src, dst)
-            except OSError:
-                shutil.copytree(src, dst)
-                logging.info('%s -> %s', src, dst)
-        elif dst.is_symlink():
-            pass
-        else:
-            # TODO: only sync changes.
-            shutil.rmtree(dst, ignore_errors=True)
-            shutil.copytree(src, dst)
-            logging.info('%s -> %s', src, dst)
+        if dst.is_symlink() and not clean:
+            return
+        src_files, src_directories = scan_tree(src)
+        dst_files, dst_directories = scan_tree(dst) if dst.is_dir() and not clean else ({}, [])
+        changed = [path for path, stat in src_files.items() if path not in dst_files or not is_synced(stat, dst_files[path], is_minified(path))]
+
+        def is_derived(path: Path) -> bool:
+            """ whether path is a precompressed variant or the current fingerprinted name of a synced file """
+            if path.suffix in COMPRESSORS:
+                path = path.with_suffix('')
+            if path in src_files:
+                return True
+            original = path.with_stem(split_fingerprint(path.stem))
+            return original != path and original in src_files and path == with_fingerprint(original, static_fingerprint(src / original, src_files[original]))
+
+        removed = [path for path in dst_files.keys() - src_files.keys() if not is_derived(path)]
+        removed_directories = sorted(set(dst_directories) - set(src_directories), key=lambda d: len(d.parts), reverse=True)
+        if dry_run:
+            for path in changed:
+                report_planned(dst / path, 'link')
+            for path in (*removed, *removed_directories):
+                report_planned(dst / path, 'remove')
+            return
+        if dst.exists() and not dst.is_dir():
+            dst.unlink()
+        dst.mkdir(parents=True, exist_ok=True)
+        for directory in src_directories:
+            (dst / directory).mkdir(exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(lambda path: publish_static(src / path, dst / path), changed):
+                pass
+        span.update(files=len(changed), bytes=sum(src_files[path].st_size for path in changed))
+        for path in removed:
+            logging.info('x %s', dst / path)
+            (dst / path).unlink()
+        for directory in removed_directories:
+            logging.info('x %s', dst / directory)
+            shutil.rmtree(dst / directory, ignore_errors=True)
+
+
+def fingerprint_jobs(jobs: Iterable[ConversionJob], manifest: Manifest = None) -> tuple[list[ConversionJob], dict[str, str]]:
+    """ give conversion targets content-hashed names, derived from the digest of their source and parameters.
+
+    :returns: the renamed jobs, and the fingerprinted url by original url.
+    """
+    renamed, urls = [], {}
+    for job in jobs:
+        target = with_fingerprint(job.target, job.inputs_digest(manifest))
+        urls[output_url(job.target)] = output_url(target)
+        renamed.append(dataclasses.replace(job, target=target))
+    return renamed, urls
+
+
+def build_resource_with_assets(resource: Resource, manifest: Manifest, dry_run: bool = False,
+                               warn: bool = True) -> tuple[list[ConversionJob], GalleryRecord]:
+    """ build the resource page, and return the asset conversions it needs and its gallery record. """
+    jobs = list(iter_asset_jobs(resource, warn=warn))
+    urls = None
+    if CONFIG.fingerprint_assets:
+        jobs, urls = fingerprint_jobs(jobs, manifest)
+    build_resource(resource, manifest, assets=(job.source for job in jobs), urls=urls, dry_run=dry_run)
+    return jobs, GalleryRecord.from_resource(resource, (lambda url: urls.get(url, url)) if urls else None)
+
+
+_worker_manifest: Manifest | None = None
+
+
+def _init_page_worker(config: Config, manifest: Manifest, source_index: SourceIndex, tracing: bool) -> None:
+    global _worker_manifest
+    configure(config)
+    _worker_manifest = manifest
+    SOURCE_INDEX.update(source_index)
+    init_worker(tracing)
+
+
+def _build_resource_in_worker(resource: Resource):
+    """ build_resource_with_assets in a worker process; also returns the manifest, image index, style cache and
+    parse cache changes, and trace events. """
+    manifest = _worker_manifest.layer()
+    jobs, record = build_resource_with_assets(resource, manifest)
+    return jobs, record, manifest.changes(), IMAGE_INDEX.take_changes(), STYLE_CACHE.take_changes(), PARSE_CACHE.take_usage(), TRACER.take_events()
+
+
+def build_resources_parallel(resources: Iterable[Resource], manifest: Manifest, max_workers: int = None) -> Iterator[tuple[list[ConversionJob], GalleryRecord]]:
+    """ build_resource_with_assets for each resource on a process pool, each worker with its own markdown parser. """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_page_worker, initargs=(CONFIG, manifest, SOURCE_INDEX, TRACER.enabled)) as executor:
+        for jobs, record, manifest_changes, image_changes, style_changes, parse_cache_usage, events in executor.map(_build_resource_in_worker, resources):
+            manifest.update(manifest_changes)
+            IMAGE_INDEX.update(image_changes)
+            STYLE_CACHE.update(style_changes)
+            PARSE_CACHE.add_usage(parse_cache_usage)
+            TRACER.add_events(events)
+            yield jobs, record
+
+
+def build_resources_serial(resources: Iterable[Resource], manifest: Manifest, release: bool = True,
+                           dry_run: bool = False, warn: bool = True) -> Iterator[tuple[list[ConversionJob], GalleryRecord]]:
+    """ build_resource_with_assets for each resource in turn, releasing its description once it is reduced to a record. """
+    for resource in resources:
+        result = build_resource_with_assets(resource, manifest, dry_run=dry_run, warn=warn)
+        if release:
+            resource.release()
+        yield result
+
+
+def iter_gallery_records(resources: Iterable[Resource], records: dict[Path, GalleryRecord], release: bool = True) -> Iterator[GalleryRecord]:
+    """ the gallery record of each resource, taken from `records` or derived and added to it. """
+    for resource in resources:
+        if resource.path not in records:
+            records[resource.path] = GalleryRecord.from_resource(resource)
+            if release:
+                resource.release()
+        yield records[resource.path]
+
+
+def build(projects: list[Project], pieces: list[Piece], manifest: Manifest, args, affected: Iterable[Resource] = None,
+          records: dict[Path, GalleryRecord] = None) -> dict[ConversionJob, BaseException]:
+    """ build all outputs selected by the command line arguments, skipping outputs that are up-to-date.
+
+    Resources are streamed through the page builder: each is parsed, rendered and its asset conversions
+    collected, then reduced to a gallery record, so that only one description is held in memory at a time
+    (one per worker when building pages in parallel).
+
+    :param affected: only (re)build the pages of these resources. Defaults to all projects and pieces.
+    :param records: gallery records by resource path, kept up-to-date; pass the same dict between rebuilds
+      to keep the records of unaffected resources. Descriptions are only kept loaded if given.
+    :returns: failed asset conversions.
+    """
+    release = records is None
+    records = {} if records is None else records
+    affected = None if affected is None else set(map(id, affected))
+    selected = [
+        resource
+        for resources, should_build in ((projects, args.should_build_project_pages), (pieces, args.should_build_piece_pages))
+        if should_build
+        for resource in resources
+        if affected is None or id(resource) in affected
+    ]
+    dry_run = args.dry_run
+    # a dry run of a clean build plans for an empty output directory: nothing in it is kept or removed
+    clean = dry_run and args.should_clean
+    if args.should_parallelize_pages and len(selected) > 1 and not dry_run:
+        if CONFIG.fingerprint_assets:
+            publish_template_assets('resource_page.html')
+        results = build_resources_parallel(selected, manifest, max_workers=args.jobs)
+    else:
+        results = build_resources_serial(selected, manifest, release=release, dry_run=dry_run)
+    jobs: list[ConversionJob] = []
+    # pages rendered before the placeholders of some of their images were made, with the sources of those images
+    waiting: list[tuple[Resource, set[Path]]] = []
+    with TRACER.span('pages', 'phase', pages=len(selected)):
+        for resource, (resource_jobs, record) in zip(selected, results):
+            jobs.extend(resource_jobs)
+            records[resource.path] = record
+            if not clean:
+                remove_stale_outputs(resource, resource_jobs, manifest, dry_run=dry_run)
+            if not dry_run and manifest.recorded(resource_page_path(resource)) is None:
+                if sources := {job.source for job in resource_jobs if PLACEHOLDERS.missing_key(job.source)}:
+                    waiting.append((resource, sources))
+    with TRACER.span('conversion', 'phase', jobs=len(jobs)):
+        failures = run_jobs(jobs, manifest=manifest, max_workers=args.jobs, dry_run=dry_run)
+    # the conversion phase makes the missing placeholders; render the pages again once all of theirs are made
+    if pending := [resource for resource, sources in waiting if not any(map(PLACEHOLDERS.missing_key, sources))]:
+        with TRACER.span('placeholders', 'phase', pages=len(pending)):
+            for resource in pending:
+                resource.release()
+            # missing assets were reported when the pages were first rendered
+            for resource, (_, record) in zip(pending, build_resources_serial(pending, manifest, release=release, warn=False)):
+                records[resource.path] = record
+    if args.should_update_gallery:
+        with TRACER.span('gallery', 'phase'):
+            build_resources_index(iter_gallery_records(projects, records, release), kind=Project, manifest=manifest, dry_run=dry_run, clean=clean)
+            build_resources_index(iter_gallery_records(pieces, records, release), kind=Piece, manifest=manifest, dry_run=dry_run, clean=clean)
+        if CONFIG.search_index:
+            with TRACER.span('search', 'phase'):
+                build_search_index((records[r.path] for r in (*projects, *pieces)), manifest=manifest, dry_run=dry_run, clean=clean)
+    if args.should_sync_static:
+        with TRACER.span('static', 'phase'):
+            for static_path in CONFIG.static_paths:
+                sync_static_path(static_path, dry_run=dry_run, clean=clean)
+    with TRACER.span('homepage', 'phase'):
+        build_homepage(manifest=manifest, dry_run=dry_run)
+    if args.should_compress:
+        with TRACER.span('compression', 'phase'):
+            compress_outputs(manifest, max_workers=args.jobs, dry_run=dry_run)
+    if failures:
+        logging.error('%d of %d asset conversions failed', len(failures), len(jobs))
+    return failures
+
+
+def discover_resources() -> tuple[list[Project], list[Piece]]:
+    """ all projects and pieces in the projects and pieces directories. """
+    SOURCE_INDEX.scan(CONFIG.projects_dir, CONFIG.pieces_dir)
+    projects = [Project.from_path(entry.path) for entry in SOURCE_INDEX.listing(CONFIG.projects_dir).values()]
+    pieces = [Piece.from_path(entry.path) for entry in SOURCE_INDEX.listing(CONFIG.pieces_dir).values()]
+    return projects, pieces
+
+
+def scan_mtimes(*directories: Path) -> dict[Path, int]:
+    """ modification times of all files in the given directories, recursively. """
+    directories = [d for d in directories if d.is_dir() and not any(other in d.parents for other in directories)]
+    mtimes = {}
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(Path(entry.path))
+                else:
+                    mtimes[Path(entry.path)] = entry.stat().st_mtime_ns
+    return mtimes
+
+
+def plan(projects: list[Project], pieces: list[Piece], args) -> int:
+    """ list the outputs a build would write, without writing anything.
+
+    Images are not decoded, so Pillow is not loaded: images missing from the image index are new or changed,
+    and are listed with all derivative widths, even if they are too small for some. Which of their derivatives a
+    build keeps (e.g. the full-size original) is not known either, so no outputs of their pages are listed for
+    removal. Descriptions are parsed, but not added to the parse cache.
+    """
+    manifest = Manifest.load()
+    if args.should_clean:
+        report_planned(CONFIG.output_dir, 'remove')
+        # every output is rewritten; only the cached digests of input files still apply
+        manifest = Manifest(manifest.path, files=manifest.files)
+    IMAGE_INDEX.probe = False
+    PARSE_CACHE.store = False
+    try:
+        build(projects, pieces, manifest, args)
+    finally:
+        report_trace(args)
+    return 0
+
+
+def report_trace(args) -> None:
+    """ write the trace file and print the timings table, if requested. """
+    if args.trace:
+        TRACER.save(args.trace)
+    if args.timings:
+        print(TRACER.format_timings())
+
+
+def watch(projects: list[Project], pieces: list[Piece], manifest: Manifest, args, records: dict[Path, GalleryRecord] = None,
+          interval: float = 0.2) -> None:
+    """ rebuild affected outputs whenever files in the input or templates directory change, until interrupted.
+
+    Templates, resources, gallery records and image metadata stay loaded between rebuilds; only resources in a
+    directory containing a changed file are reloaded, and only their pages are rebuilt (all pages if a template changed).
+
+    :param records: gallery records from the initial build.
+    """
+    records = {} if records is None else records
+    resources: dict[Path, Resource] = {r.path: r for r in (*projects, *pieces)}
+    # path each resource was loaded from: its directory or, for explicit targets, its description file
+    sources: dict[Path, Path] = {r.path: r._description_path or r.path for r in resources.values()}
+    mtimes = scan_mtimes(CONFIG.input_dir, CONFIG.templates_dir)
+    logging.info('watching %s for changes', CONFIG.input_dir)
+    while True:
+        time.sleep(interval)
+        new_mtimes = scan_mtimes(CONFIG.input_dir, CONFIG.templates_dir)
+        changed = {path for path in mtimes.keys() | new_mtimes.keys() if mtimes.get(path) != new_mtimes.get(path)}
+        mtimes = new_mtimes
+        if not changed:
+            continue
+        start = time.perf_counter()
+        TRACER.take_events()
+        for path in changed:
+            SOURCE_INDEX.forget(path.parent)
+        affected = []
+        for resources_dir, cls in ((CONFIG.projects_dir, Project), (CONFIG.pieces_dir, Piece)):
+            for directory in {resources_dir / path.relative_to(resources_dir).parts[0] for path in changed if resources_dir in path.parents}:
+                records.pop(directory, None)
+                if not directory.is_dir():
+                    resources.pop(directory, None)
+                    continue
+                if directory not in sources and not args.targets:
+                    sources[directory] = directory
+                if directory in sources:
+                    resources[directory] = cls.from_path(sources[directory])
+                    affected.append(resources[directory])
+        if any(CONFIG.templates_dir in path.parents for path in changed):
+            template_paths.cache_clear()
+            template_asset_paths.cache_clear()
+            template_vocabulary.cache_clear()
+            affected = None
+        elif (CONFIG.fingerprint_assets or CONFIG.critical_css) and any(path.suffix == '.css' for path in changed):
+            # pages reference (or inline) the stylesheets
+            affected = None
+        projects = [r for r in resources.values() if isinstance(r, Project)]
+        pieces = [r for r in resources.values() if isinstance(r, Piece)]
+        try:
+            build(projects, pieces, manifest, args, affected=affected, records=records)
+        except Exception:
+            logging.exception('rebuild failed')
+        finally:
+            manifest.save()
+            IMAGE_INDEX.save()
+            PLACEHOLDERS.save()
+            STYLE_CACHE.save()
+            report_trace(args)
+        logging.info('rebuilt after %d changed files in %.3fs', len(changed), time.perf_counter() - start)
 
 
 def main():
     import argparse
     parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=Path, help='config file (default: config.ini in the working directory)')
     parser.add_argument('targets', type=Path, nargs='*',
                         help='project .md files to build / include in gallery.\n'
                              'if not given, includes all .md files in the projects directory.')
     parser.add_argument('--clean', action=argparse.BooleanOptionalAction, dest='should_clean', default=False, help='clean output directory before building')
     parser.add_argument('--project-pages', action=argparse.BooleanOptionalAction, dest='should_build_project_pages', default=True, help='build project pages')
     parser.add_argument('--piece-pages', action=argparse.BooleanOptionalAction, dest='should_build_piece_pages', default=True, help='build piece pages')
-    parser.add_argument('--gallery', action=argparse.BooleanOptionalAction, dest='should_update_gallery', default=True, help='update project index and homepage')
+    parser.add_argument('--gallery', action=argparse.BooleanOptionalAction, dest='should_update_gallery', default=True, help='update project index, search index and homepage')
     parser.add_argument('--sync-static', action=argparse.BooleanOptionalAction, dest='should_sync_static', default=False, help='copy/link static files to output')
+    parser.add_argument('--parallel-pages', action=argparse.BooleanOptionalAction, dest='should_parallelize_pages', default=False, help='parse and render project and piece pages on a process pool')
+    parser.add_argument('--compress', action=argparse.BooleanOptionalAction, dest='should_compress', default=False, help='write precompressed .gz (and .br) variants of changed text outputs')
+    parser.add_argument('--fingerprint', action=argparse.BooleanOptionalAction, dest='should_fingerprint', default=None, help='reference images and stylesheets by content-hashed names (default: fingerprint in the [caching] config section)')
+    parser.add_argument('--watch', action='store_true', dest='should_watch', help='keep running and rebuild when source files change (use -v to see rebuilds)')
+    parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', help='list the outputs that would be written, without writing anything or decoding images')
+    parser.add_argument('--trace', type=Path, metavar='FILE', help='write a trace of all build phases and units of work to FILE (Chrome trace event format, open in chrome://tracing or ui.perfetto.dev)')
+    parser.add_argument('--timings', action='store_true', help='print the time of each phase and the slowest items after building')
+    parser.add_argument('-j', '--jobs', type=int, dest='jobs', default=os.cpu_count(), help='number of parallel asset conversions')
     parser.add_argument('-v', '--verbose', action='count', dest='verbosity', default=0)
     parser.add_argument('-q', '--quiet', action='count', dest='quietness', default=0)
     args = parser.parse_args()
+    if args.dry_run and args.should_watch:
+        parser.error('--dry-run cannot be combined with --watch')
     log_level: int = 30 - 10 * (args.verbosity - args.quietness)
     targets: list[Path] = args.targets
 
     logging.getLogger().setLevel(log_level)
+    load_config(args.config)
+    if args.should_fingerprint is not None:
+        CONFIG.fingerprint_assets = args.should_fingerprint
+    TRACER.enabled = bool(args.trace or args.timings)
 
-    if targets:
-        projects = [Project.from_path(file) for file in targets if CONFIG.projects_dir in file.parents]
-        pieces = [Piece.from_path(file) for file in targets if CONFIG.pieces_dir in file.parents]
-        other = [file for file in targets if CONFIG.projects_dir not in file.parents and CONFIG.pieces_dir not in file.parents]
-        if other:
-            logging.warning('ignoring files outside of projects and pieces directories: %s', other)
-    else:
-        projects = [Project.from_path(file) for file in CONFIG.projects_dir.iterdir()]
-        pieces = [Piece.from_path(file) for file in CONFIG.pieces_dir.iterdir()]
+    with TRACER.span('discovery', 'phase'):
+        if targets:
+            projects = [Project.from_path(file) for file in targets if CONFIG.projects_dir in file.parents]
+            pieces = [Piece.from_path(file) for file in targets if CONFIG.pieces_dir in file.parents]
+            other = [file for file in targets if CONFIG.projects_dir not in file.parents and CONFIG.pieces_dir not in file.parents]
+            if other:
+                logging.warning('ignoring files outside of projects and pieces directories: %s', other)
+        else:
+            projects, pieces = discover_resources()
+
+    if args.dry_run:
+        return plan(projects, pieces, args)
 
     if args.should_clean:
         shutil.rmtree(CONFIG.output_dir, ignore_errors=True)
 
-    if args.should_build_project_pages:
-        for project in projects:
-            build_resource(project)
-    if args.should_build_piece_pages:
-        for piece in pieces:
-            build_resource(piece)
-    if args.should_update_gallery:
-        build_resources_index(projects, kind=Project)
-        build_resources_index(pieces, kind=Piece)
-    if args.should_sync_static:
-        for static_path in CONFIG.static_paths:
-            sync_static_path(static_path)
-    build_homepage()
+    manifest = Manifest.load()
+    # when watching, keep descriptions and gallery records loaded for fast rebuilds
+    records = {} if args.should_watch else None
+    try:
+        failures = build(projects, pieces, manifest, args, records=records)
+    finally:
+        manifest.save()
+        IMAGE_INDEX.save()
+        PLACEHOLDERS.save()
+        STYLE_CACHE.save()
+        report_trace(args)
+    logging.info('document cache: %d hits, %d misses', PARSE_CACHE.hits, PARSE_CACHE.misses)
+    if not targets and args.should_build_project_pages and args.should_build_piece_pages:
+        PARSE_CACHE.prune()
+        prune_store(manifest)
+    if args.should_watch:
+        try:
+            watch(projects, pieces, manifest, args, records=records)
+        except KeyboardInterrupt:
+            pass
+    return 1 if failures else 0
+
 
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main())
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, ClassVar, Generic, TypeVar
+
+from config import CONFIG
+
+V = TypeVar('V')
+
+
+class JsonCache(Generic[V]):
+    """ Base of the persistent caches kept as a json object in the build directory, e.g. the image index.
+
+    Entries are loaded on first use and written back by save() if any were added. Entries added in a worker process
+    are collected with take_changes() and merged into the cache of the main process with update().
+    """
+
+    FILENAME: ClassVar[str]
+    """ name of the cache file in the build directory """
+    DESCRIPTION: ClassVar[str]
+    """ what the cache holds, for log messages """
+
+    def __init__(self, path: Path = None):
+        self._path = path
+        self._entries: dict[str, V] | None = None
+        self._dirty = False
+        self._changes: dict[str, V] = {}
+
+    @property
+    def path(self) -> Path:
+        """ defaults to FILENAME in the build directory of the active config """
+        return self._path or CONFIG.build_dir / self.FILENAME
+
+    @property
+    def entries(self) -> dict[str, V]:
+        if self._entries is None:
+            self._entries = self._load()
+        return self._entries
+
+    def _load(self) -> dict[str, V]:
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning('ignoring invalid %s %s: %s', self.DESCRIPTION, self.path, e)
+            return {}
+        return self._decode(data)
+
+    def _decode(self, data: dict[str, Any]) -> dict[str, V]:
+        """ entries from the json data of the cache file; override for values that are not plain json. """
+        return data
+
+    def _encode(self, entries: dict[str, V]) -> dict[str, Any]:
+        """ json data of the cache file from the entries; the inverse of _decode. """
+        return entries
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(self._encode(self.entries), sort_keys=True))
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def put(self, key: str, value: V) -> None:
+        self.entries[key] = self._changes[key] = value
+        self._dirty = True
+
+    def take_changes(self) -> dict[str, V]:
+        """ entries added since the last call, e.g. to send from a worker process to the main process. """
+        changes, self._changes = self._changes, {}
+        return changes
+
+    def update(self, changes: dict[str, V]) -> None:
+        if changes:
+            self.entries.update(changes)
+            self._dirty = True
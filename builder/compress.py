@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import concurrent.futures
+import gzip
+import importlib.util
+import logging
+from pathlib import Path
+from typing import Callable
+
+from config import CONFIG
+from manifest import Manifest, digest
+from tracing import TRACER
+from util import report_planned, scan_tree
+
+COMPRESSIBLE_SUFFIXES = ('.html', '.css', '.js', '.svg', '.json')
+
+
+def gzip_compress(data: bytes) -> bytes:
+    # fixed mtime so unchanged inputs give identical output
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotli_compress(data: bytes) -> bytes:
+    import brotli
+    return brotli.compress(data, quality=11)
+
+
+COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {'.gz': gzip_compress}
+""" suffix of the compressed variant -> compression function """
+if importlib.util.find_spec('brotli') is not None:
+    COMPRESSORS['.br'] = brotli_compress
+
+
+def variant_path(path: Path, suffix: str) -> Path:
+    """ 'index.html', '.gz' -> 'index.html.gz' """
+    return path.with_name(path.name + suffix)
+
+
+def compress_file(path: Path, suffixes: list[str], min_saving: float) -> dict[str, bool]:
+    """ write compressed variants next to path, or remove them if they would not save `min_saving` of the size.
+
+    :returns: suffix -> whether the variant was written
+    """
+    data = path.read_bytes()
+    written = {}
+    for suffix in suffixes:
+        with TRACER.span(f'{path.relative_to(CONFIG.output_dir)}{suffix}', 'compress', bytes_in=len(data)) as span:
+            compressed = COMPRESSORS[suffix](data)
+            span['bytes_out'] = len(compressed)
+        target = variant_path(path, suffix)
+        if len(compressed) > len(data) * (1 - min_saving):
+            target.unlink(missing_ok=True)
+            written[suffix] = False
+            continue
+        tmp = target.with_name(f'.{target.name}.tmp')
+        tmp.write_bytes(compressed)
+        tmp.replace(target)
+        logging.info('%s -> %s (%d%%)', path, target, 100 * len(compressed) // max(1, len(data)))
+        written[suffix] = True
+    return written
+
+
+def compress_outputs(manifest: Manifest, min_saving: float = None, max_workers: int = None, dry_run: bool = False) -> None:
+    """ write precompressed (.gz, and .br if brotli is installed) variants of all text outputs.
+
+    Only outputs that changed since the last build are compressed; compression runs on a thread pool.
+
+    :param dry_run: only list the variants that would be written.
+    """
+    if min_saving is None:
+        min_saving = CONFIG.compression_min_saving
+    files, _ = scan_tree(CONFIG.output_dir)
+    pending: dict[Path, tuple[str, list[str]]] = {}
+    for relative_path in files:
+        if relative_path.suffix not in COMPRESSIBLE_SUFFIXES:
+            continue
+        path = CONFIG.output_dir / relative_path
+        inputs_digest = manifest.inputs_digest([path], f'min_saving={min_saving}')
+        incompressible_digest = digest(inputs_digest, 'incompressible')
+        suffixes = []
+        for suffix in COMPRESSORS:
+            target = variant_path(path, suffix)
+            recorded = manifest.recorded(target)
+            if not (manifest.is_up_to_date(target, inputs_digest) or recorded == incompressible_digest and not target.exists()):
+                suffixes.append(suffix)
+        if suffixes:
+            pending[path] = inputs_digest, suffixes
+    if dry_run:
+        for path, (_, suffixes) in pending.items():
+            for suffix in suffixes:
+                report_planned(variant_path(path, suffix), 'compress')
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(compress_file, path, suffixes, min_saving): path for path, (_, suffixes) in pending.items()}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            inputs_digest, _ = pending[path]
+            if (e := future.exception()) is not None:
+                logging.error('failed to compress %s: %s', path, e)
+                continue
+            for suffix, written in future.result().items():
+                manifest.record(variant_path(path, suffix), inputs_digest if written else digest(inputs_digest, 'incompressible'), [path])
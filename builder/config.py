@@ -20,6 +20,31 @@ class Config:
     pieces_dir: Path = input_dir / 'pieces'
     homepage_dir: Path = input_dir / 'homepage'
     background_color: str = '#ffffff'
+    image_widths: Collection[int] = (320, 640, 1280, 2560)
+    """ widths of the scaled-down derivatives generated for each image """
+    image_quality: int = 80
+    image_placeholders: str = 'blur'
+    """ placeholder shown while images load: 'blur' (tiny blurred image), 'color' (average color) or 'none' """
+    conversion_memory_per_worker: int = 1024
+    """ estimated memory in MiB that decoding and converting images may take per conversion worker; 0 for no limit """
+    compression_min_saving: float = 0.1
+    """ fraction of the size a precompressed variant must save to be kept """
+    fingerprint_assets: bool = False
+    """ reference images and stylesheets by content-hashed file names, so they can be cached indefinitely """
+    minify: bool = True
+    """ minify stylesheets and rendered pages """
+    critical_css: bool = True
+    """ inline the css rules the template of each page needs into the page, and load its stylesheets without blocking rendering """
+    gallery_page_size: int = 48
+    """ number of items per gallery index page; 0 puts all items on one page """
+    gallery_eager_items: int = 6
+    """ number of items at the top of each gallery page whose images are loaded eagerly, the rest are lazy-loaded """
+    gallery_json: bool = False
+    """ also write the items of each gallery page as json, for fetching further pages incrementally """
+    search_index: bool = True
+    """ write a sharded json search index of all pages, for searching in the browser """
+    search_prefix_length: int = 2
+    """ number of leading characters of the terms in each shard of the search index """
 
     def __post_init__(self):
         if not self.root_dir:
@@ -57,29 +82,44 @@ class Config:
             pieces_dir=parser['paths'].getpath('pieces', cls.pieces_dir),
             homepage_dir=parser['paths'].getpath('homepage', cls.homepage_dir),
             static_paths=parser['paths'].getpathlist('static', cls.static_paths),
-            background_color=parser['conversion'].get('background_color', cls.background_color)
+            background_color=parser['conversion'].get('background_color', cls.background_color),
+            image_widths=sorted(map(int, parser['conversion'].getlist('widths', cls.image_widths))),
+            image_quality=parser['conversion'].getint('quality', cls.image_quality),
+            image_placeholders=parser['conversion'].get('placeholders', cls.image_placeholders),
+            conversion_memory_per_worker=parser['conversion'].getint('memory_per_worker', cls.conversion_memory_per_worker),
+            compression_min_saving=parser['compression'].getfloat('min_saving', cls.compression_min_saving) if parser.has_section('compression') else cls.compression_min_saving,
+            fingerprint_assets=parser['caching'].getboolean('fingerprint', cls.fingerprint_assets) if parser.has_section('caching') else cls.fingerprint_assets,
+            minify=parser['optimization'].getboolean('minify', cls.minify) if parser.has_section('optimization') else cls.minify,
+            critical_css=parser['optimization'].getboolean('critical_css', cls.critical_css) if parser.has_section('optimization') else cls.critical_css,
+            gallery_page_size=parser['gallery'].getint('page_size', cls.gallery_page_size) if parser.has_section('gallery') else cls.gallery_page_size,
+            gallery_eager_items=parser['gallery'].getint('eager_items', cls.gallery_eager_items) if parser.has_section('gallery') else cls.gallery_eager_items,
+            gallery_json=parser['gallery'].getboolean('json', cls.gallery_json) if parser.has_section('gallery') else cls.gallery_json,
+            search_index=parser['search'].getboolean('index', cls.search_index) if parser.has_section('search') else cls.search_index,
+            search_prefix_length=parser['search'].getint('prefix_length', cls.search_prefix_length) if parser.has_section('search') else cls.search_prefix_length,
         )
 
 
-def _get_config() -> Config:
-    import argparse
-    import sys
+CONFIG = Config(root_dir=None)
+""" the active config; empty until load_config() or configure() is called, e.g. by build.main(). """
+
+
+def configure(config: Config) -> Config:
+    """ make config the active config. CONFIG is updated in place, so modules that imported it see the change. """
+    for field in dataclasses.fields(Config):
+        setattr(CONFIG, field.name, getattr(config, field.name))
+    return CONFIG
+
+
+def load_config(config_path: Path = None) -> Config:
+    """ load config_path, or config.ini in the working directory if it exists, as the active config. """
     import warnings
-    parser = argparse.ArgumentParser(add_help=False)
-    parser.add_argument('-c', '--config', type=Path)
-    args, unparsed = parser.parse_known_args()
-    sys.argv = [sys.argv[0], *unparsed]  # ⚠️
-    config_path: Path | None = args.config
     default_config_path: Path = Path.cwd() / 'config.ini'
 
     if config_path and not config_path.exists():
         raise FileNotFoundError(f'config file not found: {config_path}')
     if config_path:
-        return Config.parse(config_path)
+        return configure(Config.parse(config_path))
     if default_config_path.exists():
-        return Config.parse(default_config_path)
+        return configure(Config.parse(default_config_path))
     warnings.warn('no config file; using default config.')
-    return Config()
-
-
-CONFIG = _get_config()
+    return configure(Config())
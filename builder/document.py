@@ -4,16 +4,43 @@ import copy
 import dataclasses
 import datetime
 import functools
+import html
+import logging
+import os
+import pickle
+import threading
 import urllib.parse
 from pathlib import Path
-from typing import Callable, Iterable, Any, ClassVar
+from typing import TYPE_CHECKING, Callable, Iterable, Any, ClassVar
 from xml.etree import ElementTree as ET
 
-import markdown
+from config import CONFIG
+from imageinfo import IMAGE_INDEX, ImageInfo
+from manifest import digest
+from placeholders import PLACEHOLDERS
+from tracing import TRACER
+from util import sluggify, get_slug_and_optional_date, temporary_path, with_poster, with_width
 
-from util import sluggify, get_slug_and_optional_date
+if TYPE_CHECKING:
+    import markdown
 
-markdown_parser = markdown.Markdown(extensions=['meta', 'extra'])
+MARKDOWN_EXTENSIONS = ('meta', 'extra')
+_thread_local = threading.local()
+
+CONVERTIBLE_IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp')
+""" local images with these suffixes are turned into <picture> elements with scaled-down derivatives """
+ANIMATABLE_IMAGE_SUFFIXES = ('.gif', '.webp')
+""" local images with these suffixes are turned into animated WebP <picture> elements if they have several frames """
+DEFAULT_IMAGE_SIZES = '(max-width: 800px) 100vw, 800px'
+""" `sizes` attribute for images in page content, matching the maximum content width in main.css """
+
+
+def get_markdown_parser() -> markdown.Markdown:
+    """ markdown parser for the current thread. Parsers are stateful, so each thread (or worker process) gets its own. """
+    if (parser := getattr(_thread_local, 'markdown_parser', None)) is None:
+        import markdown
+        parser = _thread_local.markdown_parser = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS)
+    return parser
 
 
 def get_highest_level_heading_tag(body: ET.Element) -> str | None:
@@ -86,20 +113,256 @@ def process_headline_image(body: ET.Element) -> None:
                 el.set('class', ' '.join(classes))
 
 
-def mutate_image_to_picture(el: ET.Element) -> ET.Element:
-    """ change an <img> element to a <picture> element with <source> and <img> children in-place. """
+def is_convertible_image(el: ET.Element) -> bool:
+    """ whether `el` is an <img> referencing a local image that the builder can convert and scale. """
+    src = urllib.parse.urlsplit(el.get('src', ''))
+    return el.tag == 'img' and not src.netloc and Path(src.path).suffix.lower() in CONVERTIBLE_IMAGE_SUFFIXES
+
+
+def mutate_image_to_picture(el: ET.Element, widths: Iterable[int] = None, sizes: str = DEFAULT_IMAGE_SIZES,
+                            info: ImageInfo = None, placeholder: str = None) -> ET.Element:
+    """ change an <img> element to a <picture> element with <source> and <img> children in-place.
+
+    The <source> offers WebP and the <img> a fallback format; both get a srcset of scaled-down derivatives
+    (e.g. img-640w.webp) for each of `widths`, which default to CONFIG.image_widths.
+    If the image dimensions are known through `info`, the <img> gets width and height attributes,
+    and derivatives at least as wide as the original are replaced by the original size.
+    A `placeholder` (css background, see placeholders.make_placeholder) is shown behind the <img> while it loads.
+    """
+    if widths is None:
+        widths = CONFIG.image_widths
     src = urllib.parse.urlsplit(el.get('src'))
     path = Path(src.path)
-    webp_url = urllib.parse.urlunsplit(src._replace(path=str(path.with_suffix('.webp'))))
-    fallback_url = urllib.parse.urlunsplit(src._replace(path=str(path.with_suffix('.jpg')))) if path.suffix == '.webp' else el.get('src')
+
+    def url(path: Path) -> str:
+        return urllib.parse.urlunsplit(src._replace(path=str(path)))
+
+    def srcset(path: Path) -> str:
+        candidates = [f'{url(with_width(path, width))} {width}w' for width in widths if info is None or width < info.width]
+        if info is not None:
+            candidates.append(f'{url(path)} {info.width}w')
+        return ', '.join(candidates)
+
+    webp_path = path.with_suffix('.webp')
+    fallback_path = path.with_suffix('.jpg') if path.suffix == '.webp' else path
+    size_attrib = dict(width=str(info.width), height=str(info.height)) if info is not None else {}
+    if placeholder:
+        size_attrib['style'] = '; '.join(filter(None, (el.get('style'), f'background: {placeholder}')))
 
     el.tag = 'picture'
-    ET.SubElement(el, 'source', srcset=webp_url, type='image/webp')
-    ET.SubElement(el, 'img', attrib=el.attrib, src=fallback_url)
+    if widths:
+        ET.SubElement(el, 'source', srcset=srcset(webp_path), sizes=sizes, type='image/webp')
+        ET.SubElement(el, 'img', attrib=el.attrib, src=url(fallback_path), srcset=srcset(path.with_suffix('.jpg')), sizes=sizes, **size_attrib)
+    else:
+        ET.SubElement(el, 'source', srcset=url(webp_path), type='image/webp')
+        ET.SubElement(el, 'img', attrib=el.attrib, src=url(fallback_path), **size_attrib)
     el.attrib = {}
     return el
 
 
+def find_image_info(el: ET.Element, base_path: Path | None) -> ImageInfo | None:
+    """ metadata of the local image referenced by an <img> element, relative to `base_path`. """
+    src = urllib.parse.urlsplit(el.get('src', ''))
+    if base_path is None or src.netloc or src.path.startswith('/'):
+        return None
+    return IMAGE_INDEX.find(base_path / src.path)
+
+
+def mutate_animation_to_picture(el: ET.Element, info: ImageInfo = None) -> ET.Element:
+    """ change an <img> element of an animated image to a lazily loaded <picture> element in-place.
+
+    The <source> offers the animation as WebP (e.g. loop.webp for loop.gif), and the <img> its first frame
+    as a still JPEG (e.g. loop-poster.jpg) for browsers without animated WebP support.
+    """
+    src = urllib.parse.urlsplit(el.get('src'))
+    path = Path(src.path)
+
+    def url(path: Path) -> str:
+        return urllib.parse.urlunsplit(src._replace(path=str(path)))
+
+    size_attrib = dict(width=str(info.width), height=str(info.height)) if info is not None else {}
+    el.tag = 'picture'
+    ET.SubElement(el, 'source', srcset=url(path.with_suffix('.webp')), type='image/webp')
+    ET.SubElement(el, 'img', attrib=el.attrib, src=url(with_poster(path).with_suffix('.jpg')), loading='lazy', decoding='async', **size_attrib)
+    el.attrib = {}
+    return el
+
+
+def mutate_local_image(el: ET.Element, base_path: Path | None, poster: bool = False) -> bool:
+    """ turn an <img> element of a local image into a <picture> element in-place, if the builder can convert it.
+
+    Animated images become an animation (see mutate_animation_to_picture), or with `poster`, a still picture
+    of their first frame; other images get scaled-down derivatives and their placeholder (see mutate_image_to_picture).
+
+    :returns: whether the placeholder of the image is not computed yet.
+    """
+    src = urllib.parse.urlsplit(el.get('src', ''))
+    suffix = Path(src.path).suffix.lower()
+    if el.tag != 'img' or src.netloc or suffix not in (*CONVERTIBLE_IMAGE_SUFFIXES, *ANIMATABLE_IMAGE_SUFFIXES):
+        return False
+    info = find_image_info(el, base_path)
+    if info is not None and info.animated:
+        if not poster:
+            mutate_animation_to_picture(el, info)
+            return False
+        el.set('src', urllib.parse.urlunsplit(src._replace(path=str(with_poster(Path(src.path)).with_suffix('.jpg')))))
+    elif not is_convertible_image(el):
+        return False
+    placeholder = PLACEHOLDERS.get(info) if info is not None else ''
+    mutate_image_to_picture(el, info=info, placeholder=placeholder)
+    return placeholder is None
+
+
+def prioritize_images(body: ET.Element, primary: ET.Element | None) -> None:
+    """ let the browser fetch the primary image first, and the other images only once they are scrolled into view.
+
+    :param primary: the <img> element of the primary image in body, or the <picture> element it was turned into.
+      Other images are assumed to be below the fold. Attributes set in the source are kept.
+    """
+    primary_imgs = set(primary.iter('img')) if primary is not None else set()
+    for img in body.iter('img'):
+        if img in primary_imgs:
+            if img.get('loading') == 'lazy':
+                del img.attrib['loading']
+            img.attrib.setdefault('fetchpriority', 'high')
+        else:
+            img.attrib.setdefault('loading', 'lazy')
+            img.attrib.setdefault('decoding', 'async')
+            img.attrib.setdefault('fetchpriority', 'low')
+
+
+def preload_link(el: ET.Element, rewrite_url: Callable[[str], str] = None) -> str:
+    """ <link rel="preload"> markup for the image shown by an <img> or <picture> element, for the <head> of its page.
+
+    Of a <picture>, the WebP <source> is preloaded: browsers without WebP support ignore the preload, and preloading
+    the fallback as well would make the others fetch the image twice.
+    """
+    rewrite_url = rewrite_url or (lambda url: url)
+    candidate = next((source for source in el.iter('source') if source.get('type') == 'image/webp'), None)
+    if candidate is None:
+        candidate = next(el.iter('img'), None)
+    if candidate is None:
+        return ''
+    attrib = {'rel': 'preload', 'as': 'image'}
+    if (srcset := candidate.get('srcset')) and candidate.get('sizes'):
+        attrib.update(imagesrcset=rewrite_srcset(srcset, rewrite_url), imagesizes=candidate.get('sizes'))
+    elif src := candidate.get('src') or srcset and parse_srcset(srcset)[0][0]:
+        attrib.update(href=rewrite_url(src))
+    else:
+        return ''
+    if candidate.get('type'):
+        attrib.update(type=candidate.get('type'))
+    return element_html(ET.Element('link', attrib, fetchpriority='high'))
+
+
+def parse_srcset(srcset: str) -> list[tuple[str, ...]]:
+    """ 'a.webp 320w, b.webp 640w' -> [('a.webp', '320w'), ('b.webp', '640w')] """
+    return [tuple(candidate.split()) for candidate in srcset.split(',') if candidate.strip()]
+
+
+def rewrite_srcset(srcset: str, fn: Callable[[str], str]) -> str:
+    return ', '.join(' '.join((fn(url), *descriptors)) for url, *descriptors in parse_srcset(srcset))
+
+
+def element_html(el: ET.Element, rewrite_url: Callable[[str], str] = None, overrides: dict[str, str] = {}, exclude: Iterable[str] = ()) -> str:
+    """ serialize an element (without its tail), rewriting urls and attributes while serializing instead of on a copy.
+
+    :param overrides: attribute values replacing existing ones, in this element and all descendants.
+    :param exclude: attributes to leave out.
+    """
+    attributes = []
+    for name, value in el.attrib.items():
+        if name in exclude:
+            continue
+        if name in overrides:
+            value = overrides[name]
+        elif rewrite_url and name in ('src', 'href'):
+            value = rewrite_url(value)
+        elif rewrite_url and name == 'srcset':
+            value = rewrite_srcset(value, rewrite_url)
+        attributes.append(f' {name}="{html.escape(value)}"')
+    if len(el) == 0 and not el.text:
+        return f'<{el.tag}{"".join(attributes)} />'
+    children = ''.join(element_html(child, rewrite_url, overrides, exclude) + html.escape(child.tail or '', quote=False) for child in el)
+    return f'<{el.tag}{"".join(attributes)}>{html.escape(el.text or "", quote=False)}{children}</{el.tag}>'
+
+
+class ParseCache:
+    """ On-disk cache of parsed markdown (element tree and raw metadata), one pickle file per document.
+
+    Entries are keyed by the markdown source and the parser configuration, so they never need invalidating;
+    `prune` removes entries that were not used by the current build.
+    """
+    VERSION = 1
+
+    def __init__(self, directory: Path = None):
+        self._directory = directory
+        self.store = True
+        """ whether to write new entries; off for dry runs, which write nothing """
+        self.hits = 0
+        self.misses = 0
+        self._used: set[str] = set()
+
+    @property
+    def directory(self) -> Path:
+        """ defaults to documents/ in the build directory of the active config """
+        return self._directory or CONFIG.build_dir / 'documents'
+
+    @classmethod
+    def key(cls, text: str) -> str:
+        import markdown
+        return digest(str(cls.VERSION), markdown.__version__, *MARKDOWN_EXTENSIONS, text)
+
+    def get(self, key: str) -> tuple[ET.Element, dict[str, list[str]]] | None:
+        self._used.add(key)
+        try:
+            with (self.directory / f'{key}.pickle').open('rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logging.warning('ignoring invalid parse cache entry %s: %s', key, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: tuple[ET.Element, dict[str, list[str]]]) -> None:
+        self._used.add(key)
+        if not self.store:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{key}.pickle'
+        # workers parsing the same text write the same entry; each through its own temporary file
+        tmp_path = temporary_path(path)
+        tmp_path.write_bytes(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        os.replace(tmp_path, path)
+
+    def take_usage(self) -> tuple[int, int, set[str]]:
+        """ hits, misses and used keys since the last call, e.g. to send from a worker process to the main process. """
+        usage = self.hits, self.misses, self._used
+        self.hits, self.misses, self._used = 0, 0, set()
+        return usage
+
+    def add_usage(self, usage: tuple[int, int, set[str]]) -> None:
+        hits, misses, used = usage
+        self.hits += hits
+        self.misses += misses
+        self._used |= used
+
+    def prune(self) -> None:
+        """ remove all entries not used since this cache was created. """
+        if not self.directory.is_dir():
+            return
+        for path in self.directory.iterdir():
+            if path.stem not in self._used:
+                path.unlink()
+
+
+PARSE_CACHE = ParseCache()
+
+
 @dataclasses.dataclass
 class Document:
     slug: str
@@ -107,7 +370,11 @@ class Document:
     """ Markdown-generated root element directly contains all <p>, <h1>, <h2>, etc. """
     primary_image: ET.Element = None
     """ image used in preview and at the top of page """
+    page_primary_image: ET.Element = None
+    """ element of the primary image in the page itself (a <picture> if it was converted), which is preloaded """
     metadata: dict[str] = dataclasses.field(default_factory=dict)
+    pending_placeholders: int = 0
+    """ number of images whose placeholder is not computed yet; they are computed when the images are converted """
 
     METADATA_TRANSFORMERS: ClassVar[dict[str, Callable[[str], Any]]] = {
         'date': datetime.date.fromisoformat
@@ -128,30 +395,45 @@ class Document:
         slug, date = get_slug_and_optional_date(path.stem)
         if date is not None:
             metadata_overrides = {'date': date, **metadata_overrides}
-        return cls.from_string(path.read_text(), slug=slug, default_metadata=default_metadata, metadata_overrides=metadata_overrides)
+        return cls.from_string(path.read_text(), slug=slug, base_path=path.parent, default_metadata=default_metadata, metadata_overrides=metadata_overrides)
 
     @classmethod
-    def from_string(cls, text: str, slug: str | None = None, *, default_metadata: dict = {}, metadata_overrides: dict = {}) -> Document:
+    def from_string(cls, text: str, slug: str | None = None, *, base_path: Path = None, default_metadata: dict = {}, metadata_overrides: dict = {}) -> Document:
         """ Create a Document from Markdown source text.
 
         :param text: Markdown source
         :param slug: document identifier. Defaults to document title.
+        :param base_path: directory relative image urls are resolved against, to look up image dimensions.
         :param default_metadata: metadata which will be overwritten by metadata extracted from the document
         :param metadata_overrides: metadata which will overwrite metadata extracted from the document
         :return: A new Document.
         """
-        inner_html = markdown_parser.reset().convert(text)
-        document_metadata = getattr(markdown_parser, 'Meta', None) or {}
+        key = ParseCache.key(text)
+        with TRACER.span(slug or key, 'parse', bytes_in=len(text)) as span:
+            if (cached := PARSE_CACHE.get(key)) is not None:
+                root, document_metadata = cached
+                span['cache'] = 'hit'
+            else:
+                markdown_parser = get_markdown_parser().reset()
+                inner_html = markdown_parser.convert(text)
+                document_metadata = getattr(markdown_parser, 'Meta', None) or {}
+                root = ET.fromstring(f'<html>{inner_html}</html>')
+                PARSE_CACHE.put(key, (root, document_metadata))
+                span['cache'] = 'miss'
         cls.transform_document_metadata(document_metadata)
         metadata = {**default_metadata, **document_metadata, **metadata_overrides}
-        root = ET.fromstring(f'<html>{inner_html}</html>')
         # deep copy to avoid problems with double-rewriting urls.
-        primary_image = copy.deepcopy(identify_primary_image(root))
-        # for img in list(root.iter('img')):
-        #     mutate_image_to_picture(img)
-        mutate_image_to_picture(primary_image)
-
-        instance = cls(slug, root, metadata=metadata, primary_image=primary_image)
+        page_primary_image = identify_primary_image(root)
+        primary_image = copy.deepcopy(page_primary_image)
+        # images are changed to pictures in place, so page_primary_image is the picture of the primary image after this
+        pending_placeholders = sum(mutate_local_image(img, base_path) for img in list(root.iter('img')))
+        prioritize_images(root, page_primary_image)
+        if primary_image is not None:
+            # galleries show a still of animated primary images
+            pending_placeholders += mutate_local_image(primary_image, base_path, poster=True)
+
+        instance = cls(slug, root, metadata=metadata, primary_image=primary_image, page_primary_image=page_primary_image,
+                       pending_placeholders=pending_placeholders)
         if instance.slug is None:
             instance.slug = sluggify(instance.title)
         return instance
@@ -160,17 +442,41 @@ class Document:
     def title(self) -> str:
         return extract_title(self.root)
 
-    def inner_html(self):
-        return ET.tostring(self.root, encoding='unicode').replace('<html>', '').replace('</html>', '')
+    def inner_html(self, rewrite_url: Callable[[str], str] = None):
+        """ :param rewrite_url: if given, urls are rewritten in a copy of the document before serializing. """
+        root = self.root
+        if rewrite_url is not None:
+            root = copy.deepcopy(root)
+            self._rewrite_urls(root, rewrite_url)
+        return ET.tostring(root, encoding='unicode').replace('<html>', '').replace('</html>', '')
+
+    def preload_html(self, rewrite_url: Callable[[str], str] = None) -> str:
+        """ <link rel="preload"> for the primary image of the page (see preload_link), or '' if it has none. """
+        if self.page_primary_image is None:
+            return ''
+        return preload_link(self.page_primary_image, rewrite_url)
 
     @staticmethod
     def _rewrite_urls(tree: ET.Element | ET.ElementTree, fn: Callable[[str], str]) -> None:
         for el in tree.iter('img'):
-            el.set('src', fn(el.get('src')))
+            if (src := el.get('src')) is not None:
+                el.set('src', fn(src))
         for el in tree.iter('a'):
-            el.set('href', fn(el.get('href')))
-        for el in tree.iter('source'):
-            el.set('srcset', ','.join(fn(src.strip()) for src in el.get('srcset').split(',')))
+            if (href := el.get('href')) is not None:
+                el.set('href', fn(href))
+        for el in tree.iter():
+            if srcset := el.get('srcset'):
+                el.set('srcset', rewrite_srcset(srcset, fn))
+
+    @property
+    def primary_image_size(self) -> tuple[int, int] | None:
+        """ (width, height) of the primary image, if known. """
+        if self.primary_image is None:
+            return None
+        img = next(self.primary_image.iter('img'))
+        if 'width' not in img.attrib or 'height' not in img.attrib:
+            return None
+        return int(img.get('width')), int(img.get('height'))
 
     def rewrite_urls(self, fn: Callable[[str], str]) -> None:
         self._rewrite_urls(self.root, fn)
@@ -192,14 +498,11 @@ class Document:
             if src := el.get('src'):
                 yield src
             if srcset := el.get('srcset'):
-                yield from (src.strip() for src in srcset.split(','))
+                yield from (url for url, *_ in parse_srcset(srcset))
 
     def iter_dependencies(self) -> Iterable[urllib.parse.SplitResult]:
         """ iterate over all local image urls referenced in the document. """
         yield from (url for src in self.iter_img_srcs() if not (url := urllib.parse.urlsplit(src)).netloc)
         # FIXME: gallery item dependencies should be separate. Also why do we yield SplitResult here?
-        if self.primary_image:
-            for src in self.iter_img_srcs(root=self.primary_image):
-                if (url := urllib.parse.urlsplit(src)).netloc:
-                    continue
-                yield url._replace(path=str(Path(url.path).with_suffix('.webp')))
+        if self.primary_image is not None:
+            yield from (url for src in self.iter_img_srcs(root=self.primary_image) if not (url := urllib.parse.urlsplit(src)).netloc)
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import mimetypes
+import os
+from pathlib import Path
+from typing import Any
+
+from cache import JsonCache
+from config import CONFIG
+from manifest import file_digest
+from sourceindex import SOURCE_INDEX
+
+mimetypes.add_type('image/webp', '.webp')
+
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.webp', '.gif')
+""" suffixes tried, in order, when looking for an image in another format """
+
+
+@dataclasses.dataclass(frozen=True)
+class ImageInfo:
+    width: int
+    height: int
+    format: str
+    mode: str
+    digest: str
+    """ digest of the file contents """
+    animated: bool
+    """ the image has more than one frame, e.g. an animated GIF or WebP """
+
+    @property
+    def is_wide(self) -> bool:
+        return self.width > self.height
+
+
+class ImageIndex(JsonCache[tuple[int, int, ImageInfo | None]]):
+    """ Persistent cache of image metadata, read from image headers only.
+
+    Entries are invalidated per file when its size or mtime changes.
+    """
+
+    FILENAME = 'images.json'
+    DESCRIPTION = 'image index'
+
+    def __init__(self, path: Path = None):
+        super().__init__(path)
+        self.probe = True
+        """ read headers of images not in the index; if False, they are treated as unknown (e.g. for --dry-run) """
+
+    def _decode(self, data: dict[str, Any]) -> dict[str, tuple[int, int, ImageInfo | None]]:
+        try:
+            return {key: (size, mtime_ns, info and ImageInfo(**info)) for key, (size, mtime_ns, info) in data.items()}
+        except TypeError as e:
+            logging.warning('ignoring outdated image index %s: %s', self.path, e)
+            return {}
+
+    def _encode(self, entries: dict[str, tuple[int, int, ImageInfo | None]]) -> dict[str, Any]:
+        return {key: (size, mtime_ns, info and dataclasses.asdict(info)) for key, (size, mtime_ns, info) in entries.items()}
+
+    def get(self, path: Path) -> ImageInfo | None:
+        """ metadata of the image at `path`, or None if it does not exist or is not an image. """
+        if (entry := SOURCE_INDEX.get(path)) is None:
+            return None
+        key = os.path.relpath(path, CONFIG.root_dir)
+        cached = self.entries.get(key)
+        if cached and cached[:2] == (entry.size, entry.mtime_ns):
+            return cached[2]
+        if not self.probe:
+            return None
+        info = self._probe(path)
+        self.put(key, (entry.size, entry.mtime_ns, info))
+        return info
+
+    def is_indexed(self, path: Path) -> bool:
+        """ whether get() answers for `path` without probing: it is in the index and unchanged, or does not exist. """
+        if (entry := SOURCE_INDEX.get(path)) is None:
+            return True
+        cached = self.entries.get(os.path.relpath(path, CONFIG.root_dir))
+        return bool(cached) and cached[:2] == (entry.size, entry.mtime_ns)
+
+    @staticmethod
+    def _probe(path: Path) -> ImageInfo | None:
+        if not (mimetypes.guess_type(path)[0] or '').startswith('image/'):
+            return None
+        import PIL.Image
+        try:
+            # opening only reads the header; pixel data is decoded on load()
+            with PIL.Image.open(path) as img:
+                width, height, format, mode = img.width, img.height, img.format, img.mode
+                # skips over the data of the first frame without decoding it, up to the header of the second
+                animated = getattr(img, 'is_animated', False)
+        except (OSError, PIL.Image.DecompressionBombError) as e:
+            logging.warning('cannot read image %s: %s', path, e)
+            return None
+        return ImageInfo(width, height, format, mode, file_digest(path), animated)
+
+    def find(self, path: Path) -> ImageInfo | None:
+        """ metadata of the image at `path`, or of an image with the same stem in another format. """
+        if info := self.get(path):
+            return info
+        return next((info for suffix in IMAGE_SUFFIXES if (info := self.get(path.with_suffix(suffix)))), None)
+
+
+IMAGE_INDEX = ImageIndex()
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from collections import ChainMap
+from pathlib import Path
+from typing import Iterable, MutableMapping
+
+from config import CONFIG
+from sourceindex import SOURCE_INDEX
+
+MANIFEST_VERSION = 2
+""" bump to invalidate all recorded digests, e.g. when the builder output changes. """
+
+
+def digest(*parts: str | bytes) -> str:
+    """ hash the given parts into a hex digest. Parts are length-prefixed so ('ab', 'c') != ('a', 'bc'). """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with path.open('rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """ Persistent record of the input digest of every build output.
+
+    An output is up-to-date if it exists and the digest of its current inputs matches the recorded one.
+    Content digests of input files are cached by size and mtime, so unchanged files are not re-read;
+    when mtimes change (e.g. in a fresh checkout) files are re-hashed, but outputs are not rebuilt.
+    """
+
+    def __init__(self, path: Path, outputs: MutableMapping[str, str] = None, inputs: MutableMapping[str, list[str]] = None,
+                 files: MutableMapping[str, tuple[int, int, str]] = None):
+        self.path = path
+        self.outputs: MutableMapping[str, str] = {} if outputs is None else outputs
+        """ output path -> digest of inputs """
+        self.inputs: MutableMapping[str, list[str]] = {} if inputs is None else inputs
+        """ output path -> paths of the input files it was built from """
+        self.files: MutableMapping[str, tuple[int, int, str]] = {} if files is None else files
+        """ input path -> (size, mtime_ns, content digest) """
+
+    @classmethod
+    def load(cls, path: Path = None) -> Manifest:
+        path = path or CONFIG.build_dir / 'manifest.json'
+        try:
+            data = json.loads(path.read_text())
+        except FileNotFoundError:
+            return cls(path)
+        except ValueError as e:
+            logging.warning('ignoring invalid manifest %s: %s', path, e)
+            return cls(path)
+        if data.get('version') != MANIFEST_VERSION:
+            logging.info('ignoring manifest %s from a different builder version', path)
+            return cls(path)
+        return cls(path, outputs=data['outputs'], inputs=data['inputs'], files={k: tuple(v) for k, v in data['files'].items()})
+
+    def layer(self) -> Manifest:
+        """ a manifest that reads through to this one but keeps its own changes, e.g. for use in a worker process. """
+        return Manifest(self.path, ChainMap({}, self.outputs), ChainMap({}, self.inputs), ChainMap({}, self.files))
+
+    def changes(self) -> Manifest:
+        """ the changes recorded in a layer, without the underlying manifest. """
+        return Manifest(self.path, self.outputs.maps[0], self.inputs.maps[0], self.files.maps[0])
+
+    def update(self, changes: Manifest) -> None:
+        """ apply changes recorded in a layer. """
+        self.outputs.update(changes.outputs)
+        self.inputs.update(changes.inputs)
+        self.files.update(changes.files)
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(dict(version=MANIFEST_VERSION, outputs=dict(self.outputs), inputs=dict(self.inputs), files=dict(self.files)), sort_keys=True))
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _key(path: Path) -> str:
+        return os.path.relpath(path, CONFIG.root_dir)
+
+    def file_digest(self, path: Path) -> str:
+        """ content digest of an input file. """
+        key = self._key(path)
+        if (entry := SOURCE_INDEX.get(path)) is None:
+            raise FileNotFoundError(f'no such file: {path}')
+        cached = self.files.get(key)
+        if cached and tuple(cached[:2]) == (entry.size, entry.mtime_ns):
+            return cached[2]
+        content_digest = file_digest(path)
+        self.files[key] = (entry.size, entry.mtime_ns, content_digest)
+        return content_digest
+
+    def is_up_to_date(self, output: Path, inputs_digest: str) -> bool:
+        return self.outputs.get(self._key(output)) == inputs_digest and output.exists()
+
+    def inputs_digest(self, inputs: Iterable[Path], *parameters: str) -> str:
+        """ digest of the contents of all input files and any other parameters that affect an output. """
+        return digest(*(self.file_digest(path) for path in inputs), *parameters)
+
+    def recorded(self, output: Path) -> str | None:
+        """ the inputs digest recorded for output, if any. """
+        return self.outputs.get(self._key(output))
+
+    def record(self, output: Path, inputs_digest: str, inputs: Iterable[Path] = ()) -> None:
+        key = self._key(output)
+        self.outputs[key] = inputs_digest
+        if inputs_keys := [self._key(path) for path in inputs]:
+            self.inputs[key] = inputs_keys
+        else:
+            self.inputs.pop(key, None)
+
+    def forget(self, output: Path) -> None:
+        self.outputs.pop(self._key(output), None)
+        self.inputs.pop(self._key(output), None)
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import re
+from typing import Callable, Collection, Iterator
+
+from cache import JsonCache
+
+P_CSS_COMMENT = re.compile(r'''("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')|/\*.*?\*/''', re.S)
+P_CSS_STRING = re.compile(r'''("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')''')
+P_CSS_PUNCTUATION = re.compile(r' ?([{};,>]) ?')
+P_CSS_SELECTOR_NAME = re.compile(r'([.#])(-?[_a-zA-Z][\w-]*)')
+P_SPACE = re.compile(r'[ \t\n\r\f]+')
+""" html and css whitespace; unlike \\s, this leaves non-breaking spaces alone """
+
+P_HTML_TOKEN = re.compile(r'''<!--.*?-->|<(pre|textarea|script|style)\b.*?</\1\s*>|<[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>''', re.S | re.I)
+P_HTML_TAG_NAME = re.compile(r'</?([a-zA-Z!][\w-]*)')
+P_HTML_CLASS_OR_ID = re.compile(r'''\b(class|id)=(?:"([^"]*)"|'([^']*)')''')
+P_STYLESHEET_LINK = re.compile(r'''<link\b(?=[^>]*\brel=["']?stylesheet\b)[^>]*\bhref=["']?(/[^/"'][^"'\s>]*)[^>]*>''', re.I)
+P_MEDIA_ATTRIBUTE = re.compile(r''' media=(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.I)
+BLOCK_TAGS = frozenset({
+    '!doctype', 'html', 'head', 'body', 'meta', 'title', 'link', 'style', 'script', 'noscript',
+    'nav', 'main', 'section', 'article', 'aside', 'header', 'footer', 'div', 'p', 'pre', 'blockquote', 'hr', 'br',
+    'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'figure', 'figcaption', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'table', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td',
+})
+""" elements whitespace next to which is not rendered, so it can be removed instead of collapsed """
+GROUPING_AT_RULES = ('@media', '@supports', '@layer', '@container')
+""" at-rules whose rules are selected individually for critical css """
+
+
+def minify_css(css: str) -> str:
+    """ remove comments and all whitespace that does not separate tokens from a stylesheet. """
+    css = P_CSS_COMMENT.sub(lambda m: m[1] or ' ', css)
+    parts = P_CSS_STRING.split(css)
+    # odd parts are string literals, which are kept as they are
+    for i in range(0, len(parts), 2):
+        code = P_SPACE.sub(' ', parts[i])
+        code = P_CSS_PUNCTUATION.sub(r'\1', code).replace(': ', ':').replace(';}', '}')
+        parts[i] = code
+    return ''.join(parts).strip()
+
+
+def iter_css_rules(css: str) -> Iterator[tuple[str, str]]:
+    """ the top-level rules of a minified stylesheet, as (prelude, block) pairs; block is '' for statements like @import. """
+    depth, start, prelude_end = 0, 0, 0
+    quote = None
+    for i, c in enumerate(css):
+        if quote:
+            if c == quote and css[i - 1] != '\\':
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == '{':
+            if depth == 0:
+                prelude_end = i
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                yield css[start:prelude_end], css[prelude_end + 1:i]
+                start = i + 1
+        elif c == ';' and depth == 0:
+            yield css[start:i], ''
+            start = i + 1
+
+
+def is_critical_selector(selector: str, vocabulary: Collection[str]) -> bool:
+    """ whether all classes ('.name') and ids ('#name') in selector are in vocabulary, i.e. it may match the markup. """
+    return all(prefix + name in vocabulary for prefix, name in P_CSS_SELECTOR_NAME.findall(selector))
+
+
+def critical_css(css: str, vocabulary: Collection[str]) -> str:
+    """ the rules of a minified stylesheet that may apply to markup with the given classes and ids.
+
+    Rules are selected by their classes and ids only: element, attribute and pseudo-class selectors are assumed to match.
+
+    :param vocabulary: class and id selectors, like '.gallery' and '#about'.
+    """
+    rules = []
+    for prelude, block in iter_css_rules(css):
+        if prelude.startswith(GROUPING_AT_RULES):
+            if inner := critical_css(block, vocabulary):
+                rules.append(f'{prelude}{{{inner}}}')
+        elif prelude.startswith('@'):
+            rules.append(f'{prelude}{{{block}}}' if block else f'{prelude};')
+        elif any(is_critical_selector(selector, vocabulary) for selector in prelude.split(',')):
+            rules.append(f'{prelude}{{{block}}}')
+    return ''.join(rules)
+
+
+def markup_vocabulary(markup: str) -> set[str]:
+    """ class and id selectors of the class and id attributes in markup, e.g. {'.gallery', '#about'}.
+
+    Values of attributes containing template expressions are split into words, so that class="{{ 'wide' if wide else 'tall' }}"
+    gives both '.wide' and '.tall' (and some harmless noise).
+    """
+    vocabulary = set()
+    for attribute, *values in P_HTML_CLASS_OR_ID.findall(markup):
+        prefix = '.' if attribute == 'class' else '#'
+        vocabulary.update(prefix + word for value in values for word in re.findall(r'-?[_a-zA-Z][\w-]*', value))
+    return vocabulary
+
+
+def _collapse_text(text: str, before: str | None, after: str | None) -> str:
+    """ collapse whitespace in text between the tags before and after, removing it next to block elements. """
+    text = P_SPACE.sub(' ', text)
+    if before is None or _tag_name(before) in BLOCK_TAGS:
+        text = text.lstrip(' ')
+    if after is None or _tag_name(after) in BLOCK_TAGS:
+        text = text.rstrip(' ')
+    return text
+
+
+def _tag_name(tag: str) -> str:
+    return (m := P_HTML_TAG_NAME.match(tag)) and m[1].lower() or ''
+
+
+def minify_html(html: str) -> str:
+    """ remove comments and collapse whitespace in html, keeping the contents of pre, textarea, script and style as is.
+
+    Whitespace is collapsed to a single space, and removed next to block elements, where it is not rendered.
+    Tags and attribute values are not changed.
+    """
+    parts = []
+    text, previous, position = '', None, 0
+    for m in P_HTML_TOKEN.finditer(html):
+        text += html[position:m.start()]
+        position = m.end()
+        if m[0].startswith('<!--'):
+            continue
+        parts += _collapse_text(text, previous, m[0]), m[0]
+        text, previous = '', m[0]
+    parts.append(_collapse_text(text + html[position:], previous, None))
+    return ''.join(parts)
+
+
+def defer_stylesheet_link(link: str) -> str:
+    """ make a stylesheet <link> load without blocking rendering: as a print stylesheet, switched to its media on load. """
+    m = P_MEDIA_ATTRIBUTE.search(link)
+    media = m and next(filter(None, m.groups())) or 'all'
+    tag = P_MEDIA_ATTRIBUTE.sub('', link)
+    deferred = tag.replace('<link', f'<link media="print" onload="this.media=\'{media}\'"', 1)
+    return f'{deferred}<noscript>{link}</noscript>'
+
+
+def inline_critical_css(html: str, critical: Callable[[str], str]) -> str:
+    """ put the critical css of all local stylesheet links in a <style> in place of the first one, and defer loading
+    of the stylesheets.
+
+    The critical css is inlined in the order of the links, and the deferred stylesheets are loaded in full, so both
+    before and after they are loaded, the cascade is the same as without inlining.
+
+    :param critical: the critical css of the stylesheet linked with the given href.
+    """
+    links = list(P_STYLESHEET_LINK.finditer(html))
+    if not links:
+        return html
+    css = ''.join(critical(m[1]) for m in links)
+    parts, position = [], 0
+    for i, m in enumerate(links):
+        parts += html[position:m.start()], f'<style>{css}</style>' if i == 0 and css else '', defer_stylesheet_link(m[0])
+        position = m.end()
+    parts.append(html[position:])
+    return ''.join(parts)
+
+
+class StyleCache(JsonCache[str]):
+    """ Persistent cache of minified stylesheets and critical css, keyed by a digest of their inputs. """
+
+    FILENAME = 'styles.json'
+    DESCRIPTION = 'style cache'
+
+    def get(self, key: str, make: Callable[[], str]) -> str:
+        """ the entry for key, made and stored if there is none. """
+        if (value := self.entries.get(key)) is None:
+            value = make()
+            self.put(key, value)
+        return value
+
+
+STYLE_CACHE = StyleCache()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import base64
+import io
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from cache import JsonCache
+from config import CONFIG
+from imageinfo import IMAGE_INDEX, ImageInfo
+
+if TYPE_CHECKING:
+    import PIL.Image
+
+PLACEHOLDER_WIDTH = 16
+""" width in pixels of blurred placeholder images """
+ALPHA_MODES = ('RGBA', 'LA', 'PA', 'P', 'RGBa', 'La')
+""" image modes that may have transparency; a placeholder would show through, so these images get none """
+
+
+def make_placeholder(img: PIL.Image.Image, kind: str) -> str:
+    """ css `background` value standing in for an image while it loads, from an already decoded (preferably small) copy.
+
+    :param kind: 'color' for the average color, or 'blur' for a tiny blurred WebP data uri on top of the average color.
+    """
+    import PIL.Image
+    import PIL.ImageFilter
+    img = img.convert('RGB')
+    r, g, b = img.resize((1, 1), PIL.Image.Resampling.BOX).getpixel((0, 0))
+    color = f'#{r:02x}{g:02x}{b:02x}'
+    if kind == 'color':
+        return color
+    height = max(1, round(img.height * PLACEHOLDER_WIDTH / img.width))
+    tiny = img.resize((PLACEHOLDER_WIDTH, height), PIL.Image.Resampling.BOX).filter(PIL.ImageFilter.GaussianBlur(1))
+    buffer = io.BytesIO()
+    tiny.save(buffer, format='WEBP', quality=30)
+    return f'{color} url(data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode()}) center / cover no-repeat'
+
+
+class PlaceholderCache(JsonCache[str]):
+    """ Persistent cache of image placeholders (see make_placeholder), keyed by the kind and the digest of the source image.
+
+    Placeholders are computed while images are converted, from the image that is decoded anyway; pages rendered
+    before that are rendered again once the placeholders of their images are known.
+    """
+
+    FILENAME = 'placeholders.json'
+    DESCRIPTION = 'placeholder cache'
+
+    @staticmethod
+    def key(info: ImageInfo | None) -> str | None:
+        """ cache key of the placeholder of an image, or None if it should not get one. """
+        if CONFIG.image_placeholders == 'none' or info is None or info.mode in ALPHA_MODES:
+            return None
+        return f'{CONFIG.image_placeholders}:{info.digest}'
+
+    def get(self, info: ImageInfo | None) -> str | None:
+        """ the placeholder of an image: '' if it gets none, None if it is not computed yet. """
+        if (key := self.key(info)) is None:
+            return ''
+        return self.entries.get(key)
+
+    def missing_key(self, source: Path) -> str | None:
+        """ the key of the placeholder of the image at source, if it should be computed. """
+        if (key := self.key(IMAGE_INDEX.get(source))) is None or key in self.entries:
+            return None
+        return key
+
+
+PLACEHOLDERS = PlaceholderCache()
@@ -1,17 +1,24 @@
 from __future__ import annotations
 
-import copy
 import dataclasses
+import datetime
 import functools
 import logging
 import urllib.parse
 from pathlib import Path
-from typing import ClassVar
+from typing import Callable, ClassVar
 
-from document import Document
+from config import CONFIG
+from document import Document, element_html
+from search import document_terms
+from sourceindex import SOURCE_INDEX
 from util import sluggify, is_wide, get_slug_and_optional_date
 
 
+GALLERY_IMAGE_SIZES = '300px'
+""" `sizes` attribute for gallery images, matching the column width in gallery.css """
+
+
 def is_relative_url(url: str):
     url = urllib.parse.urlsplit(url, scheme='file')
     return url.scheme == 'file' and not url.path.startswith('/')
@@ -32,7 +39,8 @@ class Resource:
     def __post_init__(self, description_path: Path = None):
         if not self.slug:
             self.slug = sluggify(self.path.stem)
-        if description_path is not None:
+        # without an explicit description path, the default is the description_path property below
+        if isinstance(description_path, Path):
             self._description_path = description_path
 
     @classmethod
@@ -44,11 +52,13 @@ class Resource:
 
     @functools.cached_property
     def asset_paths(self) -> list[Path]:
-        return [p for p in self.path.iterdir() if p.suffix not in ('.md', '.html', '')]
+        return [entry.path for entry in SOURCE_INDEX.files(self.path) if entry.path.suffix not in ('.md', '.html', '')]
 
     @functools.cached_property
     def description_path(self) -> Path | None:
-        candidates = set(self.path.glob('*.md'))
+        if self._description_path:
+            return self._description_path
+        candidates = {entry.path for entry in SOURCE_INDEX.files(self.path) if entry.path.suffix == '.md'}
         if len(candidates) <= 1:
             return next(iter(candidates), None)
         if (p := self.path / 'index.md') in candidates:
@@ -67,17 +77,41 @@ class Resource:
             return self._generate_description()
         return Document.load_file(self.description_path)
 
-    @functools.cached_property
-    def description_with_absolute_urls(self) -> Document:
-        doc = copy.deepcopy(self.description)
-
-        def fn(url: str):
-            if not is_relative_url(url):
-                return url
-            return str((Path('/') / self.DIRECTORY / self.slug / url).resolve())
-
-        doc.rewrite_urls(fn)
-        return doc
+    @property
+    def url(self) -> str:
+        return str(Path('/') / self.DIRECTORY / self.slug) + '/'
+
+    def absolute_url(self, url: str) -> str:
+        """ make a url relative to the resource page absolute. """
+        if not is_relative_url(url):
+            return url
+        return str((Path('/') / self.DIRECTORY / self.slug / url).resolve())
+
+    def gallery_picture_html(self, rewrite_url: Callable[[str], str] = None) -> str:
+        """ markup of the primary image for gallery items: absolute urls, no classes and gallery-sized.
+
+        Serialized directly from the description, without copying it.
+
+        :param rewrite_url: applied to the absolute urls, e.g. to fingerprint them.
+        """
+        if self.description.primary_image is None:
+            return ''
+        url = self.absolute_url if rewrite_url is None else lambda url: rewrite_url(self.absolute_url(url))
+        return element_html(self.description.primary_image, url, overrides=dict(sizes=GALLERY_IMAGE_SIZES), exclude=('class',))
+
+    @property
+    def is_wide(self) -> bool:
+        """ an explicit .wide class on the primary image takes precedence, otherwise use the image dimensions. """
+        if self.description.primary_image is None:
+            return False
+        if 'wide' in next(self.description.primary_image.iter('img')).get('class', '').split():
+            return True
+        size = self.description.primary_image_size
+        return size is not None and size[0] > size[1]
+
+    def release(self) -> None:
+        """ drop the parsed description and everything derived from it; it is loaded again when needed. """
+        self.__dict__.pop('description', None)
 
     def _generate_description(self) -> Document:
         """ generate a simple description document for when no index.md is present. """
@@ -90,7 +124,7 @@ class Resource:
             classes = '.wide .headline' if is_wide(path) else '.headline'
             headline_img = f'![{alt}]({relative_path}){{{classes}}}'
         md = f'{headline_img}\n# {self.slug}'
-        return Document.from_string(md, slug=self.slug)
+        return Document.from_string(md, slug=self.slug, base_path=self.path)
 
 
 @dataclasses.dataclass
@@ -101,3 +135,46 @@ class Piece(Resource):
 @dataclasses.dataclass
 class Project(Resource):
     DIRECTORY: ClassVar[Path] = Path('projects')
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class GalleryRecord:
+    """ Everything the gallery index and the search index need of a resource.
+
+    Small enough to keep for thousands of resources after their descriptions have been released.
+    """
+    directory: Path
+    """ resource output directory, e.g. pieces/ """
+    slug: str
+    title: str | None
+    picture: str
+    """ markup of the primary image, see Resource.gallery_picture_html() """
+    width: int | None
+    height: int | None
+    wide: bool
+    date: datetime.date | None
+    description_path: Path | None
+    terms: tuple[tuple[str, int], ...] = ()
+    """ search terms with their weights, see search.document_terms; empty if CONFIG.search_index is not set """
+
+    @classmethod
+    def from_resource(cls, resource: Resource, rewrite_url: Callable[[str], str] = None) -> GalleryRecord:
+        """ :param rewrite_url: applied to the absolute urls in the picture markup. """
+        description = resource.description
+        width, height = description.primary_image_size or (None, None)
+        return cls(
+            directory=resource.DIRECTORY,
+            slug=resource.slug,
+            title=description.title,
+            picture=resource.gallery_picture_html(rewrite_url),
+            width=width,
+            height=height,
+            wide=resource.is_wide,
+            date=description.metadata.get('date'),
+            description_path=resource.description_path,
+            terms=document_terms(description) if CONFIG.search_index else (),
+        )
+
+    @property
+    def url(self) -> str:
+        return str(Path('/') / self.directory / self.slug) + '/'
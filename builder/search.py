@@ -0,0 +1,148 @@
+from __future__ import annotations
+
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import unicodedata
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable
+
+from compress import COMPRESSORS
+from config import CONFIG
+from manifest import Manifest, digest
+from util import report_planned, write_atomic
+
+if TYPE_CHECKING:
+    from document import Document
+    from resources import GalleryRecord
+
+SEARCH_INDEX_VERSION = 1
+""" bump when the format of the index files changes; it is part of index.json for the client to check """
+P_TERM = re.compile(r'[^\W_]{2,}')
+TERM_WEIGHTS = dict(title=3, metadata=2, body=1)
+""" weight of an occurrence of a term by where in the document it occurs """
+
+
+def normalize(text: str) -> str:
+    """ lowercase text without diacritics, e.g. 'Één Café' -> 'een cafe'. The client normalizes queries the same way. """
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def terms(text: str) -> list[str]:
+    """ the searchable words in text: normalized runs of at least two letters or digits. """
+    return P_TERM.findall(normalize(text))
+
+
+def document_terms(document: Document) -> tuple[tuple[str, int], ...]:
+    """ the terms of a document with their weight (see TERM_WEIGHTS), from its title, metadata values and body text. """
+    weights = collections.Counter()
+    metadata = (value.isoformat() if isinstance(value, datetime.date) else value for value in document.metadata.values())
+    for kind, text in (('title', document.title or ''),
+                       ('metadata', ' '.join(value for value in metadata if isinstance(value, str))),
+                       ('body', ' '.join(document.root.itertext()))):
+        for term in terms(text):
+            weights[term] += TERM_WEIGHTS[kind]
+    return tuple(sorted(weights.items()))
+
+
+def shard_key(term: str) -> str:
+    """ name of the shard a term is in: its first CONFIG.search_prefix_length characters, or '_' if those are not ascii. """
+    prefix = term[:CONFIG.search_prefix_length]
+    return prefix if prefix.isascii() else '_'
+
+
+def assign_ids(urls: Iterable[str], ids: dict[str, int]) -> dict[str, int]:
+    """ stable document ids: urls keep their id from the previous build, new urls get the lowest unused ids. """
+    urls = list(urls)
+    assigned = {url: ids[url] for url in urls if url in ids}
+    taken = set(assigned.values())
+    free = (i for i in itertools.count() if i not in taken)
+    for url in urls:
+        if url not in assigned:
+            assigned[url] = next(free)
+    return assigned
+
+
+def build_search_index(records: Iterable[GalleryRecord], manifest: Manifest = None, dry_run: bool = False,
+                       clean: bool = False) -> list[Path]:
+    """ write the search index of the given resources to search/ in the output directory.
+
+    The index consists of
+      - index.json: the format version, the shard prefix length, the shard names, and the url, title, date and
+        kind (e.g. pieces) of each document by id;
+      - shards/<prefix>.json: an inverted index of all terms starting with prefix (see shard_key), mapping each term
+        to [document id, weight] pairs, highest weight first.
+    A client normalizes the words of a query (see normalize), fetches index.json and the shard of each word, and
+    ranks the documents with terms starting with the words.
+
+    Document ids are kept between builds (in search.json in the build directory), so that a changed document only
+    changes the shards containing its terms: only files whose content changed are written (and precompressed), and
+    shards without terms are removed.
+
+    :param dry_run: only list the files that would be written or removed.
+    :param clean: plan for an empty output directory (--dry-run --clean), with no shards to remove.
+    :returns: the paths of the index files.
+    """
+    records = sorted(records, key=lambda r: r.url)
+    ids_path = CONFIG.build_dir / 'search.json'
+    try:
+        previous_ids = json.loads(ids_path.read_text())
+    except FileNotFoundError:
+        previous_ids = {}
+    except ValueError as e:
+        logging.warning('ignoring invalid search ids %s: %s', ids_path, e)
+        previous_ids = {}
+    ids = assign_ids((r.url for r in records), previous_ids)
+
+    documents = [None] * (max(ids.values(), default=-1) + 1)
+    postings: dict[str, dict[str, list[tuple[int, int]]]] = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in records:
+        documents[ids[record.url]] = [record.url, record.title, record.date and record.date.isoformat(), record.directory.as_posix()]
+        for term, weight in record.terms:
+            postings[shard_key(term)][term].append((ids[record.url], weight))
+
+    output_dir = CONFIG.output_dir / 'search'
+    files = {output_dir / 'index.json': dict(version=SEARCH_INDEX_VERSION, prefix_length=CONFIG.search_prefix_length,
+                                             shards=sorted(postings), documents=documents)}
+    for key, shard in postings.items():
+        files[output_dir / 'shards' / f'{key}.json'] = {term: sorted(pairs, key=lambda p: (-p[1], p[0])) for term, pairs in sorted(shard.items())}
+    for path, data in files.items():
+        text = json.dumps(data, separators=(',', ':'))
+        content_digest = digest(text)
+        if manifest is not None and manifest.is_up_to_date(path, content_digest):
+            continue
+        if dry_run:
+            report_planned(path)
+            continue
+        logging.info('-> %s', path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, text)
+        if manifest is not None:
+            manifest.record(path, content_digest)
+
+    shards_dir = output_dir / 'shards'
+    for path in (shards_dir.iterdir() if shards_dir.is_dir() and not clean else ()):
+        if path in files or path.suffix in COMPRESSORS and path.with_suffix('') in files:
+            continue
+        if dry_run:
+            report_planned(path, 'remove')
+            continue
+        logging.info('x %s', path)
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+        if manifest is not None:
+            manifest.forget(path)
+    if not dry_run and ids != previous_ids:
+        ids_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = ids_path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(ids, sort_keys=True))
+        os.replace(tmp_path, ids_path)
+    return list(files)
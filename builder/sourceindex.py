@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+import dataclasses
+import os
+import stat
+from pathlib import Path
+
+from config import CONFIG
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class SourceEntry:
+    path: Path
+    is_dir: bool
+    size: int
+    mtime_ns: int
+
+
+class SourceIndex:
+    """ In-memory listing of the source directories, each read with a single os.scandir call.
+
+    `scan` lists the projects and pieces directories and every resource directory in them up front; other
+    directories under the input directory are listed on first use. Resources, assets, the image index and the
+    manifest look up which files exist, and their sizes and mtimes, here instead of calling stat() for each one.
+
+    Listings are not refreshed by themselves: directories whose contents change must be forgotten (e.g. in watch mode).
+    Paths outside the input, projects and pieces directories are always stat'ed.
+    """
+
+    def __init__(self):
+        self._listings: dict[Path, dict[str, SourceEntry]] = {}
+
+    @property
+    def roots(self) -> tuple[Path, ...]:
+        return CONFIG.input_dir, CONFIG.projects_dir, CONFIG.pieces_dir
+
+    def scan(self, *directories: Path) -> None:
+        """ list the given directories and their subdirectories (one level deep). """
+        for directory in directories:
+            for entry in self.listing(directory).values():
+                if entry.is_dir:
+                    self.listing(entry.path)
+
+    def listing(self, directory: Path) -> dict[str, SourceEntry]:
+        """ entries of directory by name; empty if it does not exist. """
+        if (entries := self._listings.get(directory)) is None:
+            entries = self._listings[directory] = self._scandir(directory)
+        return entries
+
+    def files(self, directory: Path) -> list[SourceEntry]:
+        """ the files (not subdirectories) in directory. """
+        return [entry for entry in self.listing(directory).values() if not entry.is_dir]
+
+    def get(self, path: Path) -> SourceEntry | None:
+        """ the entry of path, or None if it does not exist. """
+        if not any(root in path.parents for root in self.roots):
+            try:
+                return self._entry(path, path.stat())
+            except FileNotFoundError:
+                return None
+        return self.listing(path.parent).get(path.name)
+
+    def exists(self, path: Path) -> bool:
+        return self.get(path) is not None
+
+    def forget(self, path: Path) -> None:
+        """ drop the listings of path and all directories above it, so they are read again when next used. """
+        for directory in (path, *path.parents):
+            self._listings.pop(directory, None)
+
+    def update(self, other: SourceIndex) -> None:
+        """ add the listings of another index, e.g. to pass the index to a worker process. """
+        self._listings.update(other._listings)
+
+    @staticmethod
+    def _entry(path: Path, st: os.stat_result) -> SourceEntry:
+        return SourceEntry(path, stat.S_ISDIR(st.st_mode), st.st_size, st.st_mtime_ns)
+
+    @classmethod
+    def _scandir(cls, directory: Path) -> dict[str, SourceEntry]:
+        try:
+            with os.scandir(directory) as entries:
+                return {entry.name: cls._entry(directory / entry.name, entry.stat()) for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+
+
+SOURCE_INDEX = SourceIndex()
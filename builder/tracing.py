@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterator
+
+
+class Tracer:
+    """ Records spans of build phases and units of work, for --trace (Chrome trace event format) and --timings.
+
+    Disabled by default, in which case a span costs little more than the function call.
+    Spans recorded in worker processes are sent back with take_events() and added with add_events().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events: list[dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args) -> Iterator[dict[str, Any]]:
+        """ time the enclosed block. Yields the span arguments, so that results (e.g. bytes written, cache hits) can be added. """
+        if not self.enabled:
+            yield args
+            return
+        start = time.time_ns()
+        try:
+            yield args
+        finally:
+            # wall clock time, so spans from different processes line up
+            end = time.time_ns()
+            self.events.append(dict(name=name, cat=category, ph='X', ts=start // 1000, dur=(end - start) // 1000,
+                                    pid=os.getpid(), tid=threading.get_native_id(), args=args))
+
+    def take_events(self) -> list[dict[str, Any]]:
+        """ events recorded since the last call, e.g. to send from a worker process to the main process. """
+        events, self.events = self.events, []
+        return events
+
+    def add_events(self, events: list[dict[str, Any]]) -> None:
+        self.events.extend(events)
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(dict(traceEvents=self.events, displayTimeUnit='ms')))
+
+    def format_timings(self, limit: int = 20) -> str:
+        """ a table of the total time per phase and the slowest units of work. """
+        phases = [e for e in self.events if e['cat'] == 'phase']
+        items = sorted((e for e in self.events if e['cat'] != 'phase'), key=lambda e: e['dur'], reverse=True)[:limit]
+        lines = ['phase                  time']
+        lines += [f'{e["name"]:<16} {e["dur"] / 1e6:9.3f}s' for e in phases]
+        lines += ['', f'slowest {len(items)} items', '      time  category  name']
+        for e in items:
+            details = ', '.join(f'{key}={value}' for key, value in e['args'].items())
+            lines.append(f'{e["dur"] / 1e3:8.1f}ms  {e["cat"]:<8}  {e["name"]}' + (f' ({details})' if details else ''))
+        return '\n'.join(lines)
+
+
+TRACER = Tracer()
+
+
+def init_worker(enabled: bool) -> None:
+    """ process pool initializer: enable tracing like in the main process, without the events inherited from it. """
+    TRACER.enabled = enabled
+    TRACER.events = []
@@ -1,10 +1,23 @@
 from __future__ import annotations
 
+import logging
+import os
 import re
 import datetime
+import shutil
+import threading
 from pathlib import Path
 
+from config import CONFIG
+from imageinfo import IMAGE_INDEX
+
 P_ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
+P_WIDTH_SUFFIX = re.compile(r'(.+)-(\d+)w')
+POSTER_SUFFIX = '-poster'
+""" suffix of the stem of the still image shown in place of an animation, e.g. 'loop-poster.jpg' for 'loop.gif' """
+FINGERPRINT_LENGTH = 10
+""" number of hex digits of the content hash in fingerprinted file names; app.yaml matches on it """
+P_FINGERPRINT_SUFFIX = re.compile(rf'(.+)\.[0-9a-f]{{{FINGERPRINT_LENGTH}}}')
 
 
 def sluggify(title: str) -> str:
@@ -22,7 +35,97 @@ def get_slug_and_optional_date(name: str) -> tuple[str, datetime.date | None]:
         return sluggify(name), None
 
 
+def with_width(path: Path, width: int) -> Path:
+    """ 'img.png', 640 -> 'img-640w.png' """
+    return path.with_stem(f'{path.stem}-{width}w')
+
+
+def split_width(stem: str) -> tuple[str, int | None]:
+    """ 'img-640w' -> ('img', 640); 'img' -> ('img', None) """
+    if m := P_WIDTH_SUFFIX.fullmatch(stem):
+        return m[1], int(m[2])
+    return stem, None
+
+
+def with_poster(path: Path) -> Path:
+    """ 'loop.gif' -> 'loop-poster.gif' """
+    return path.with_stem(path.stem + POSTER_SUFFIX)
+
+
+def split_poster(stem: str) -> tuple[str, bool]:
+    """ 'loop-poster' -> ('loop', True); 'loop' -> ('loop', False) """
+    if stem.endswith(POSTER_SUFFIX) and stem != POSTER_SUFFIX:
+        return stem.removesuffix(POSTER_SUFFIX), True
+    return stem, False
+
+
+def with_fingerprint(path: Path, content_digest: str) -> Path:
+    """ 'main.css', 'abcdef0123456789...' -> 'main.abcdef0123.css' """
+    return path.with_name(f'{path.stem}.{content_digest[:FINGERPRINT_LENGTH]}{path.suffix}')
+
+
+def split_fingerprint(stem: str) -> str:
+    """ 'main.abcdef0123' -> 'main' """
+    if m := P_FINGERPRINT_SUFFIX.fullmatch(stem):
+        return m[1]
+    return stem
+
+
 def is_wide(path: Path) -> bool:
     """ Return true if the image width is greater than the height. """
-    # todo: implement
-    return False
+    info = IMAGE_INDEX.get(path)
+    return info is not None and info.is_wide
+
+
+def report_planned(path: Path, action: str = 'write') -> None:
+    """ print an output that would be written, for --dry-run. """
+    print(f'{action} {os.path.relpath(path, CONFIG.root_dir)}')
+
+
+def temporary_path(path: Path) -> Path:
+    """ a hidden path next to path to write it to before moving it into place, unique to this process and thread
+    so that concurrent writers of the same path (e.g. page workers publishing a static file) do not collide. """
+    return path.with_name(f'.{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    """ hardlink src to dst, or copy it if linking is not possible, atomically replacing dst. """
+    try:
+        if os.path.samefile(src, dst):
+            return
+    except FileNotFoundError:
+        pass
+    tmp = temporary_path(dst)
+    tmp.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp)
+        logging.info('%s => %s', src, dst)
+    except OSError:
+        shutil.copy2(src, tmp)
+        logging.info('%s -> %s', src, dst)
+    os.replace(tmp, dst)
+    # renaming a link onto another link to the same file does nothing, leaving tmp in place
+    tmp.unlink(missing_ok=True)
+
+
+def write_atomic(path: Path, text: str) -> None:
+    """ write text to path via a temporary file, so readers never see a partially written file. """
+    tmp_path = temporary_path(path)
+    tmp_path.write_text(text)
+    os.replace(tmp_path, path)
+
+
+def scan_tree(root: Path) -> tuple[dict[Path, os.stat_result], list[Path]]:
+    """ stat results of all files under root, and all directories under root, by path relative to root. """
+    files, directories = {}, []
+    pending = [Path()]
+    while pending:
+        directory = pending.pop()
+        with os.scandir(root / directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    directories.append(directory / entry.name)
+                    pending.append(directory / entry.name)
+                else:
+                    files[directory / entry.name] = entry.stat()
+    return files, directories
@@ -0,0 +1,63 @@
+// Search box for gallery pages, using the index written by builder/search.py.
+// index.json is fetched on first use, and the shard of each word as it is typed; words must match the start of a term.
+(() => {
+    const form = document.querySelector('form.search');
+    const results = document.querySelector('.search-results');
+    if (!form || !results) return;
+    const input = form.querySelector('input');
+    const root = '/search/';
+    let index = null;
+    const shards = new Map();
+
+    // same as normalize() and terms() in search.py
+    const normalize = text => text.toLowerCase().normalize('NFKD').replace(/\p{M}/gu, '');
+    const terms = text => normalize(text).match(/[\p{L}\p{N}]{2,}/gu) || [];
+
+    const fetchJson = url => fetch(url).then(response => response.ok ? response.json() : {});
+
+    async function shard(word) {
+        index ??= await fetchJson(root + 'index.json');
+        const prefix = word.slice(0, index.prefix_length);
+        const key = /^[\x00-\x7f]*$/.test(prefix) ? prefix : '_';
+        if (!index.shards.includes(key)) return {};
+        if (!shards.has(key)) shards.set(key, fetchJson(`${root}shards/${key}.json`));
+        return shards.get(key);
+    }
+
+    // score of each document containing all words
+    async function search(query) {
+        let scores = null;
+        for (const word of terms(query)) {
+            const postings = await shard(word);
+            const wordScores = new Map();
+            for (const [term, pairs] of Object.entries(postings)) {
+                if (!term.startsWith(word)) continue;
+                for (const [id, weight] of pairs) wordScores.set(id, (wordScores.get(id) || 0) + weight);
+            }
+            scores = scores === null ? wordScores : new Map([...scores].filter(([id]) => wordScores.has(id)).map(([id, score]) => [id, score + wordScores.get(id)]));
+        }
+        return [...(scores || [])].sort((a, b) => b[1] - a[1]).map(([id]) => index.documents[id]);
+    }
+
+    function show(documents, query) {
+        results.replaceChildren(...documents.map(([url, title, date, kind]) => {
+            const item = document.createElement('li');
+            const link = item.appendChild(document.createElement('a'));
+            link.href = url;
+            link.textContent = title || url;
+            item.append(` ${kind}${date ? ', ' + date : ''}`);
+            return item;
+        }));
+        results.hidden = !query;
+        if (query && !documents.length) results.append(Object.assign(document.createElement('li'), {textContent: 'No results'}));
+    }
+
+    let pending = 0;
+    input.addEventListener('input', async () => {
+        const query = input.value, request = ++pending;
+        const documents = query.trim() ? await search(query) : [];
+        if (request === pending) show(documents, query.trim());
+    });
+    form.addEventListener('submit', event => event.preventDefault());
+    form.hidden = false;
+})();